@@ -0,0 +1,58 @@
+"""Benchmark del camino de entrada del webhook sobre payloads grabados.
+
+Grabar payloads reales con WEBHOOK_RECORD_PATH=updates.jsonl (una línea por update,
+anonimizados salvo WEBHOOK_RECORD_RAW=1) y luego ejecutar:
+
+    python bench_webhook.py updates.jsonl [repeticiones]
+"""
+import sys
+import time
+
+import webhook_codec
+
+
+def bench(label, func, payloads, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for raw in payloads:
+            func(raw)
+    elapsed = time.perf_counter() - start
+    per_update = elapsed / (repeat * len(payloads)) * 1e6
+    print(f"{label:<32} {elapsed:8.3f}s  {per_update:8.2f} µs/update")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    with open(sys.argv[1], "rb") as f:
+        payloads = [line.rstrip(b"\r\n") for line in f if line.strip()]
+    if not payloads:
+        print("❌ El archivo no contiene payloads.")
+        sys.exit(1)
+
+    decoded = [webhook_codec.loads(raw) for raw in payloads]
+    handled = [data for data in decoded if webhook_codec.is_handled(data)]
+    print(f"{len(payloads)} payloads, {len(handled)} con handler, x{repeat} repeticiones")
+
+    bench("json (stdlib)", webhook_codec._stdlib_loads, payloads, repeat)
+    for name in ("ujson", "orjson"):
+        try:
+            bench(name, webhook_codec._load_backend(name), payloads, repeat)
+        except ImportError:
+            print(f"{name:<32} no instalado")
+    bench("filtro previo", webhook_codec.is_handled, decoded, repeat)
+
+    try:
+        from telegram import Update
+    except ImportError:
+        print("python-telegram-bot no instalado: se omite Update.de_json")
+        return
+    bench("Update.de_json (todos)", lambda data: Update.de_json(data, None), decoded, repeat)
+    if handled:
+        bench("Update.de_json (filtrados)", lambda data: Update.de_json(data, None), handled, repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
 import os
 import json
+import gzip
 import tempfile
 import logging
 import asyncio
+import signal
+import functools
+import time
+import heapq
+import re
+import bisect
+import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from aiohttp import web
 from telegram import (
@@ -12,6 +22,7 @@ from telegram import (
     LabeledPrice,
     InputMediaVideo,
     InputMediaPhoto,
+    InlineQueryResultCachedPhoto,
 )
 from telegram.ext import (
     Application,
@@ -20,9 +31,14 @@ from telegram.ext import (
     MessageHandler,
     ContextTypes,
     PreCheckoutQueryHandler,
+    InlineQueryHandler,
     filters,
 )
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
+import httpx
 import firebase_admin
+import webhook_codec
 from firebase_admin import credentials, firestore
 
 # --- Inicializar Firestore con variable de entorno JSON doblemente serializada ---
@@ -60,11 +76,12 @@ logger = logging.getLogger(__name__)
 # --- Variables en memoria ---
 # MODIFICADO: Ahora user_premium guarda un diccionario {expire_at: datetime, plan_type: str}
 user_premium = {}          # {user_id: {expire_at: datetime, plan_type: str}}
-user_daily_views = {}      # {user_id: {date: count}}
+user_daily_views = {}      # {user_id: count} solo para el día UTC views_day
+views_day = str(datetime.utcnow().date())
 content_packages = {}      # {pkg_id: {photo_id, caption, video_id}}
 known_chats = set()
 current_photo = {}
-series_data = {}           # {serie_id: {"title", "photo_id", "caption", "capitulos": [video_id, ...], ...}}
+series_data = {}           # {serie_id: {"title", "photo_id", "caption", "num_capitulos"}} (solo cabeceras)
 current_series = {}        # {user_id: {"title", "photo_id", "caption", "serie_id", "capitulos": []}}
 
 # --- Firestore colecciones ---
@@ -73,43 +90,111 @@ COLLECTION_VIDEOS = "videos"
 COLLECTION_VIEWS = "user_daily_views"
 COLLECTION_CHATS = "known_chats"
 COLLECTION_SERIES = "series_data"
+SUBCOLLECTION_CHAPTERS = "capitulos"  # series_data/{serie_id}/capitulos/{índice}
+COLLECTION_BROADCASTS = "broadcast_jobs"
+COLLECTION_CONTENT_VIEWS = "content_views"
+COLLECTION_META = "meta"  # documentos de control (p. ej. último día limpiado)
+COLLECTION_PAYMENTS = "payments"  # registro de cobros, id = telegram_payment_charge_id
+
+# --- Seguimiento de cambios ---
+# En vez de reescribir todas las colecciones en cada guardado, se anotan las
+# claves modificadas de cada diccionario en memoria y solo se escriben esos documentos.
+FIRESTORE_BATCH_LIMIT = 500  # Máximo de operaciones por batch en Firestore
+
+_dirty = {
+    COLLECTION_VIDEOS: set(),  # pkg_id
+    COLLECTION_VIEWS: set(),   # user_id (str)
+    COLLECTION_CHATS: set(),   # chat_id
+    SUBCOLLECTION_CHAPTERS: set(),  # (serie_id, índice); antes que las cabeceras
+    COLLECTION_SERIES: set(),  # serie_id
+}
+
+def mark_dirty(collection, key):
+    """Marca un documento como modificado para escribirlo en el próximo save_data_async()."""
+    _dirty[collection].add(key)
+
+def commit_writes(writes):
+    """Escribe una lista de (doc_ref, datos) en batches de como máximo FIRESTORE_BATCH_LIMIT.
+    Si datos es None el documento se elimina."""
+    for i in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, data in writes[i:i + FIRESTORE_BATCH_LIMIT]:
+            if data is None:
+                batch.delete(doc_ref)
+            else:
+                batch.set(doc_ref, data)
+        batch.commit()
 
 # --- Funciones Firestore (Síncronas) ---
-def save_user_premium_firestore():
-    batch = db.batch()
-    for uid, data in user_premium.items(): # MODIFICADO: 'data' ahora es un dict
-        doc_ref = db.collection(COLLECTION_USERS).document(str(uid))
-        exp = data["expire_at"]
-        if exp.tzinfo is None:
-            batch.set(doc_ref, {"expire_at": exp.replace(tzinfo=timezone.utc).isoformat(), "plan_type": data["plan_type"]}) # MODIFICADO: Guardar plan_type
+def serialize_user_premium(data):
+    exp = data["expire_at"]
+    if exp.tzinfo is None:
+        exp = exp.replace(tzinfo=timezone.utc)
+    return {"expire_at": exp.isoformat(), "plan_type": data["plan_type"]} # MODIFICADO: Guardar plan_type
+
+def record_payment_firestore(user_id, charge_id, plan, payment):
+    """Guarda en una transacción el plan del usuario y la entrada del registro de cobros.
+    Si el cobro ya estaba registrado (update reenviado) no escribe nada, y si el plan
+    guardado vence después que el nuevo (pagos solapados) solo se escribe el registro.
+    Devuelve (aplicado, plan vigente del usuario tras el cobro)."""
+    user_ref = db.collection(COLLECTION_USERS).document(str(user_id))
+    ledger_ref = db.collection(COLLECTION_PAYMENTS).document(charge_id)
+
+    @firestore.transactional
+    def apply(transaction):
+        # En una transacción todas las lecturas van antes de las escrituras
+        ledger = ledger_ref.get(transaction=transaction)
+        user_doc = user_ref.get(transaction=transaction)
+        stored = parse_user_premium(user_doc) if user_doc.exists else None
+        if ledger.exists:
+            return False, stored or parse_user_premium(ledger)
+        plan_doc = serialize_user_premium(plan)
+        if stored is not None and stored["expire_at"] > plan["expire_at"]:
+            current = stored
         else:
-            batch.set(doc_ref, {"expire_at": exp.isoformat(), "plan_type": data["plan_type"]}) # MODIFICADO: Guardar plan_type
-    batch.commit()
+            transaction.set(user_ref, plan_doc)
+            current = plan
+        transaction.set(ledger_ref, {**payment, **plan_doc, "user_id": user_id, "created_at": firestore.SERVER_TIMESTAMP})
+        return True, current
 
-def load_user_premium_firestore():
-    docs = db.collection(COLLECTION_USERS).stream()
-    result = {}
-    for doc in docs:
-        data = doc.to_dict()
-        try:
-            expire_at_str = data.get("expire_at")
-            plan_type = data.get("plan_type", "premium_legacy") # MODIFICADO: Cargar plan_type, default para compatibilidad
-            if expire_at_str:
-                expire_at = datetime.fromisoformat(expire_at_str)
-                if expire_at.tzinfo is None:
-                    expire_at = expire_at.replace(tzinfo=timezone.utc)
-                result[int(doc.id)] = {"expire_at": expire_at, "plan_type": plan_type} # MODIFICADO: Guardar como dict
-        except Exception as e:
-            logger.error(f"Error al cargar fecha premium para {doc.id}: {e}")
-            pass
-    return result
+    return apply(db.transaction())
 
-def save_videos_firestore():
-    batch = db.batch()
-    for pkg_id, content in content_packages.items():
-        doc_ref = db.collection(COLLECTION_VIDEOS).document(pkg_id)
-        batch.set(doc_ref, content)
-    batch.commit()
+def parse_user_premium(doc):
+    data = doc.to_dict()
+    try:
+        expire_at_str = data.get("expire_at")
+        plan_type = data.get("plan_type", "premium_legacy") # MODIFICADO: Cargar plan_type, default para compatibilidad
+        if expire_at_str:
+            expire_at = datetime.fromisoformat(expire_at_str)
+            if expire_at.tzinfo is None:
+                expire_at = expire_at.replace(tzinfo=timezone.utc)
+            return {"expire_at": expire_at, "plan_type": plan_type} # MODIFICADO: Guardar como dict
+    except Exception as e:
+        logger.error(f"Error al cargar fecha premium para {doc.id}: {e}")
+    return None
+
+def load_user_state_firestore(user_id, day):
+    """Lee en una sola llamada el plan de un usuario y su contador de vistas del día."""
+    user_ref = db.collection(COLLECTION_USERS).document(str(user_id))
+    views_ref = db.collection(COLLECTION_VIEWS).document(str(user_id))
+    premium = None
+    views = 0
+    for doc in db.get_all([user_ref, views_ref]):
+        if not doc.exists:
+            continue
+        if doc.reference.path == user_ref.path:
+            premium = parse_user_premium(doc)
+        else:
+            data = doc.to_dict()
+            if data.get("date") == day:
+                views = data.get("count", 0)
+    return premium, views
+
+def videos_writes(keys=None):
+    return [
+        (db.collection(COLLECTION_VIDEOS).document(pkg_id), content_packages.get(pkg_id))
+        for pkg_id in (list(content_packages) if keys is None else keys)
+    ]
 
 def load_videos_firestore():
     docs = db.collection(COLLECTION_VIDEOS).stream()
@@ -118,61 +203,397 @@ def load_videos_firestore():
         result[doc.id] = doc.to_dict()
     return result
 
-def save_user_daily_views_firestore():
-    batch = db.batch()
-    for uid, views in user_daily_views.items():
+# Cada documento guarda solo el contador del día: {"date", "count", "expire_at"}.
+# expire_at permite configurar una política TTL de Firestore sobre la colección;
+# cleanup_stale_views_firestore() borra igualmente los días anteriores.
+VIEWS_RETENTION_DAYS = int(os.getenv("VIEWS_RETENTION_DAYS", "2"))
+
+def user_daily_views_writes(keys=None):
+    expire_at = datetime.fromisoformat(views_day).replace(tzinfo=timezone.utc) + timedelta(days=VIEWS_RETENTION_DAYS)
+    writes = []
+    for uid in (list(user_daily_views) if keys is None else keys):
+        count = user_daily_views.get(uid)
+        if count is None:
+            continue
         doc_ref = db.collection(COLLECTION_VIEWS).document(uid)
-        batch.set(doc_ref, views)
-    batch.commit()
+        writes.append((doc_ref, {"date": views_day, "count": count, "expire_at": expire_at}))
+    return writes
+
+VIEWS_CLEANUP_DOC = "views_cleanup"
+
+def cleanup_stale_views_firestore(today):
+    """Borra los documentos de días anteriores (incluido el formato antiguo {fecha: cuenta}).
+    El último día limpiado se guarda en meta/views_cleanup: los arranques en frío del mismo
+    día leen ese documento y no recorren la colección otra vez."""
+    meta_ref = db.collection(COLLECTION_META).document(VIEWS_CLEANUP_DOC)
+    meta = meta_ref.get()
+    if meta.exists and meta.to_dict().get("day") == today:
+        return
+    deleted = 0
+    stale = []
+    for doc in db.collection(COLLECTION_VIEWS).select(["date"]).stream():
+        if doc.to_dict().get("date") != today:
+            stale.append((doc.reference, None))
+        if len(stale) >= FIRESTORE_BATCH_LIMIT:
+            commit_writes(stale)
+            deleted += len(stale)
+            stale = []
+    commit_writes(stale)
+    deleted += len(stale)
+    meta_ref.set({"day": today})
+    if deleted:
+        logger.info(f"🧹 {deleted} contadores de vistas antiguos eliminados")
+
+# Vistas por contenido: un documento por día y contenido, id "{fecha}_{clave}", con
+# {"date", "key", "count", "expire_at"}. El tamaño de cada documento es fijo aunque crezca
+# el catálogo, y cada flush escribe (con Increment y merge) solo las claves que cambiaron.
+CONTENT_VIEWS_RETENTION_DAYS = int(os.getenv("CONTENT_VIEWS_RETENTION_DAYS", "30"))
+
+def commit_content_view_increments(deltas):
+    """deltas = {fecha: {clave: incremento}}; un set(merge=True) por fecha y clave."""
+    ops = [(date, key, n) for date, counts in deltas.items() for key, n in counts.items()]
+    for i in range(0, len(ops), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for date, key, n in ops[i:i + FIRESTORE_BATCH_LIMIT]:
+            expire_at = datetime.fromisoformat(date).replace(tzinfo=timezone.utc) + timedelta(days=CONTENT_VIEWS_RETENTION_DAYS)
+            batch.set(
+                db.collection(COLLECTION_CONTENT_VIEWS).document(f"{date}_{key}"),
+                {"date": date, "key": key, "count": firestore.Increment(n), "expire_at": expire_at},
+                merge=True,
+            )
+        batch.commit()
 
-def load_user_daily_views_firestore():
-    docs = db.collection(COLLECTION_VIEWS).stream()
+def load_content_views_firestore(dates):
+    """{fecha: {clave: vistas}} de las fechas indicadas (una consulta, un documento por contenido visto)."""
     result = {}
-    for doc in docs:
-        result[doc.id] = doc.to_dict()
+    query = db.collection(COLLECTION_CONTENT_VIEWS).where("date", "in", list(dates)).select(["date", "key", "count"])
+    for doc in query.stream():
+        data = doc.to_dict()
+        if "key" not in data:
+            continue # Formato anterior {"counts": {...}} por día: caduca por expire_at
+        result.setdefault(data["date"], {})[data["key"]] = data.get("count", 0)
     return result
 
-def save_known_chats_firestore():
-    doc_ref = db.collection(COLLECTION_CHATS).document("chats")
-    doc_ref.set({"chat_ids": list(known_chats)})
+# Un documento por chat (id = chat_id); registrar o quitar un chat escribe un solo documento.
+# LEGACY_CHATS_DOC es el antiguo documento único {"chat_ids": [...]}, que se migra al cargar.
+LEGACY_CHATS_DOC = "chats"
+
+def known_chats_writes(keys=None):
+    writes = []
+    for chat_id in (list(known_chats) if keys is None else keys):
+        doc_ref = db.collection(COLLECTION_CHATS).document(str(chat_id))
+        writes.append((doc_ref, {"chat_id": chat_id} if chat_id in known_chats else None))
+    return writes
+
+def migrate_legacy_known_chats_firestore():
+    legacy_ref = db.collection(COLLECTION_CHATS).document(LEGACY_CHATS_DOC)
+    doc = legacy_ref.get()
+    if not doc.exists:
+        return
+    chat_ids = doc.to_dict().get("chat_ids", [])
+    writes = [(db.collection(COLLECTION_CHATS).document(str(chat_id)), {"chat_id": chat_id}) for chat_id in chat_ids]
+    # El documento antiguo se borra en el último batch, después de copiar todos los chats
+    writes.append((legacy_ref, None))
+    commit_writes(writes)
+    logger.info(f"known_chats migrado a un documento por chat ({len(chat_ids)} chats)")
 
 def load_known_chats_firestore():
-    doc_ref = db.collection(COLLECTION_CHATS).document("chats")
-    doc = doc_ref.get()
-    if doc.exists:
-        data = doc.to_dict()
-        return set(data.get("chat_ids", []))
-    return set()
+    migrate_legacy_known_chats_firestore()
+    result = set()
+    for doc in db.collection(COLLECTION_CHATS).stream():
+        chat_id = doc.to_dict().get("chat_id")
+        if chat_id is not None:
+            result.add(chat_id)
+    return result
 
-def save_series_firestore():
-    batch = db.batch()
-    for serie_id, serie in series_data.items():
-        doc_ref = db.collection(COLLECTION_SERIES).document(serie_id)
-        batch.set(doc_ref, serie)
-    batch.commit()
+# Cada serie es una cabecera pequeña {"title", "photo_id", "caption", "num_capitulos"} y
+# sus capítulos son documentos {"index", "video_id"} en la subcolección "capitulos".
+# Cada capítulo es un documento pequeño (se escriben al finalizar la serie, antes que la
+# cabecera) y el file_id se lee bajo demanda.
+# Las series antiguas con el array "capitulos" en la cabecera se migran al cargar.
+CHAPTER_CACHE_MAX = int(os.getenv("CHAPTER_CACHE_MAX", "5000"))  # capítulos
+_chapter_cache = OrderedDict()  # {(serie_id, índice): video_id}, orden LRU
+
+def chapter_ref(serie_id, index):
+    # Índice con ceros a la izquierda para que los documentos se ordenen por capítulo
+    return db.collection(COLLECTION_SERIES).document(serie_id).collection(SUBCOLLECTION_CHAPTERS).document(f"{index:05d}")
+
+def series_writes(keys=None):
+    return [
+        (db.collection(COLLECTION_SERIES).document(serie_id), series_data.get(serie_id))
+        for serie_id in (list(series_data) if keys is None else keys)
+    ]
+
+def chapter_writes(keys=None):
+    writes = []
+    for serie_id, index in (list(_chapter_cache) if keys is None else keys):
+        video_id = _chapter_cache.get((serie_id, index))
+        writes.append((chapter_ref(serie_id, index), {"index": index, "video_id": video_id} if video_id else None))
+    return writes
+
+def load_chapter_firestore(serie_id, index):
+    doc = chapter_ref(serie_id, index).get()
+    return doc.to_dict().get("video_id") if doc.exists else None
+
+def migrate_legacy_series_firestore(legacy):
+    """Pasa los arrays "capitulos" de {serie_id: datos} a la subcolección y devuelve las
+    cabeceras nuevas. No modifica legacy: si el commit falla sigue siendo legible."""
+    chapters = []
+    headers = {}
+    for serie_id, data in legacy.items():
+        capitulos = data["capitulos"]
+        header = {key: value for key, value in data.items() if key != "capitulos"}
+        header["num_capitulos"] = len(capitulos)
+        chapters.extend(
+            (chapter_ref(serie_id, index), {"index": index, "video_id": video_id})
+            for index, video_id in enumerate(capitulos)
+        )
+        headers[serie_id] = header
+    # Las cabeceras se reescriben al final, después de copiar todos los capítulos
+    commit_writes(chapters + [(db.collection(COLLECTION_SERIES).document(serie_id), header) for serie_id, header in headers.items()])
+    logger.info(f"series_data migrado a subcolecciones ({len(legacy)} series, {len(chapters)} capítulos)")
+    return headers
 
 def load_series_firestore():
     docs = db.collection(COLLECTION_SERIES).stream()
     result = {}
+    legacy = {}
     for doc in docs:
-        result[doc.id] = doc.to_dict()
+        data = doc.to_dict()
+        if "capitulos" in data:
+            legacy[doc.id] = data
+        result[doc.id] = data
+    if legacy:
+        try:
+            result.update(migrate_legacy_series_firestore(legacy))
+        except Exception as e:
+            # Se sirven con su array (get_chapter_video lo usa) y se reintenta en la próxima carga
+            logger.error(f"Error migrando series antiguas, se reintentará: {e}")
+            for serie_id, data in legacy.items():
+                result[serie_id] = dict(data, num_capitulos=len(data["capitulos"]))
     return result
 
+WRITERS = {
+    COLLECTION_VIDEOS: videos_writes,
+    COLLECTION_VIEWS: user_daily_views_writes,
+    COLLECTION_CHATS: known_chats_writes,
+    SUBCOLLECTION_CHAPTERS: chapter_writes,
+    COLLECTION_SERIES: series_writes,
+}
+
 # --- Guardar y cargar todo ---
-def save_data():
-    save_user_premium_firestore()
-    save_videos_firestore()
-    save_user_daily_views_firestore()
-    save_known_chats_firestore()
-    save_series_firestore()
-
-def load_data():
-    global user_premium, content_packages, user_daily_views, known_chats, series_data
-    user_premium = load_user_premium_firestore()
-    content_packages = load_videos_firestore()
-    user_daily_views = load_user_daily_views_firestore()
-    known_chats = load_known_chats_firestore()
-    series_data = load_series_firestore()
+# Colecciones que no escribe save_data_async() sino su propio flusher (escritura diferida)
+WRITE_BEHIND = {COLLECTION_VIEWS}
+
+def take_dirty(collections=None):
+    """Extrae y limpia las claves pendientes de cada colección."""
+    taken = {}
+    for collection, keys in _dirty.items():
+        if collections is None and collection in WRITE_BEHIND:
+            continue
+        if collections is not None and collection not in collections:
+            continue
+        if keys:
+            taken[collection] = set(keys)
+            keys.clear()
+    return taken
+
+def restore_dirty(taken):
+    """Vuelve a marcar claves cuya escritura falló."""
+    for collection, keys in taken.items():
+        _dirty[collection].update(keys)
+
+def collect_writes(taken):
+    writes = []
+    for collection, keys in taken.items():
+        writes.extend(WRITERS[collection](keys))
+    return writes
+
+# --- Acceso asíncrono a Firestore ---
+# El cliente de firebase_admin es síncrono: cada commit se ejecuta en un pool de
+# hilos acotado para no bloquear el event loop (webhook y handlers de PTB).
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "4"))
+storage_executor = ThreadPoolExecutor(max_workers=FIRESTORE_MAX_WORKERS, thread_name_prefix="firestore")
+
+async def run_storage(func, *args, **kwargs):
+    """Ejecuta una función bloqueante de Firestore en el pool de hilos."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(storage_executor, functools.partial(func, *args, **kwargs))
+
+async def save_data_async():
+    # Los documentos se serializan en el event loop (foto consistente de memoria);
+    # solo el commit de red va al pool de hilos.
+    taken = take_dirty()
+    if not taken:
+        return
+    try:
+        await run_storage(commit_writes, collect_writes(taken))
+    except Exception:
+        restore_dirty(taken)
+        raise
+
+# --- Instantánea local del catálogo ---
+# content_packages + series_data se guardan periódicamente en un JSON comprimido.
+# En un arranque en frío se sirve desde la instantánea y se reconcilia con Firestore
+# en segundo plano, así el primer update no espera a leer todo el catálogo.
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", "catalog_snapshot.json.gz")
+CATALOG_SNAPSHOT_INTERVAL = int(os.getenv("CATALOG_SNAPSHOT_INTERVAL", "300"))  # segundos
+CATALOG_SNAPSHOT_FORMAT = 2  # 2: series_data solo con cabeceras (sin array de capítulos)
+catalog_version = 0  # marca de versión (ms) del último cambio del catálogo en memoria
+
+def catalog_changed():
+    global catalog_version
+    catalog_version = max(catalog_version + 1, int(time.time() * 1000))
+
+def load_catalog_firestore():
+    return load_videos_firestore(), load_series_firestore()
+
+def catalog_keys():
+    """Claves del catálogo en memoria al empezar una lectura de Firestore (ver apply_catalog)."""
+    return set(content_packages), set(series_data)
+
+def apply_catalog(videos, series, keys_before):
+    """Reemplaza el catálogo en memoria por el leído de Firestore. Solo se conservan los
+    contenidos añadidos localmente mientras se leía o aún sin escribir; lo que ya no está
+    en Firestore (p. ej. borrado a mano) desaparece aunque viniera de la instantánea."""
+    global content_packages, series_data
+    videos_before, series_before = keys_before
+    for pkg_id, pkg in content_packages.items():
+        if pkg_id not in videos_before or pkg_id in _dirty[COLLECTION_VIDEOS]:
+            videos.setdefault(pkg_id, pkg)
+    for serie_id, serie in series_data.items():
+        if serie_id not in series_before or serie_id in _dirty[COLLECTION_SERIES]:
+            series.setdefault(serie_id, serie)
+    changed = videos != content_packages or series != series_data
+    content_packages = videos
+    series_data = series
+    if changed:
+        catalog_changed()
+        invalidate_chapter_grids()
+        rebuild_search_index()
+
+def write_catalog_snapshot(payload):
+    tmp_path = CATALOG_SNAPSHOT_PATH + ".tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        f.write(payload)
+    os.replace(tmp_path, CATALOG_SNAPSHOT_PATH)
+
+def load_catalog_snapshot():
+    """Carga el catálogo desde la instantánea local. Devuelve False si no hay una válida."""
+    global content_packages, series_data, catalog_version
+    if not os.path.exists(CATALOG_SNAPSHOT_PATH):
+        return False
+    try:
+        with gzip.open(CATALOG_SNAPSHOT_PATH, "rb") as f:
+            snapshot = json.loads(f.read())
+        if snapshot.get("format") != CATALOG_SNAPSHOT_FORMAT:
+            logger.info("Instantánea del catálogo con formato antiguo, se ignora")
+            return False
+        content_packages = snapshot["content_packages"]
+        series_data = snapshot["series_data"]
+        catalog_version = snapshot["version"]
+    except Exception as e:
+        logger.warning(f"Instantánea del catálogo inválida, se ignora: {e}")
+        return False
+    logger.info(f"📦 Catálogo cargado desde instantánea v{catalog_version} ({snapshot.get('saved_at')})")
+    rebuild_search_index()
+    return True
+
+async def save_catalog_snapshot():
+    # Se serializa en el event loop para tener una foto consistente del catálogo
+    version = catalog_version
+    payload = json.dumps({
+        "format": CATALOG_SNAPSHOT_FORMAT,
+        "version": version,
+        "saved_at": datetime.now(timezone.utc).isoformat(),
+        "content_packages": content_packages,
+        "series_data": series_data,
+    }).encode("utf-8")
+    await run_storage(write_catalog_snapshot, payload)
+    return version
+
+RECONCILE_MAX_DELAY = 300  # segundos, tope del backoff al reconciliar
+
+async def reconcile_catalog():
+    # Se reintenta con backoff: sin esto un error transitorio dejaría la instantánea
+    # (con lo borrado en Firestore) hasta el próximo reinicio. No bloquea "catalog".
+    delay = STARTUP_RETRY_DELAY
+    while True:
+        try:
+            keys_before = catalog_keys()
+            apply_catalog(*await run_storage(load_catalog_firestore), keys_before)
+            logger.info("📦 Catálogo reconciliado con Firestore")
+            return
+        except Exception as e:
+            logger.error(f"Error reconciliando el catálogo con Firestore, reintento en {delay}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONCILE_MAX_DELAY)
+
+# --- Arranque por etapas ---
+# El puerto se abre antes de cargar datos. Catálogo y chats se cargan en paralelo y
+# cada handler espera (con @requires) solo al estado que necesita; mientras tanto
+# los updates quedan retenidos en vez de fallar. Los usuarios se cargan bajo demanda.
+STARTUP_RETRY_DELAY = 5  # segundos entre reintentos de carga
+_ready = {"catalog": asyncio.Event(), "chats": asyncio.Event(), "trending": asyncio.Event()}
+
+def requires(*states):
+    """Decorador de handlers: espera a que los estados indicados estén cargados."""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            for state in states:
+                if not _ready[state].is_set():
+                    await _ready[state].wait()
+            return await handler(update, context)
+        return wrapper
+    return decorator
+
+async def _load_until_ready(state, load):
+    while True:
+        try:
+            await load()
+            break
+        except Exception as e:
+            logger.error(f"Error cargando {state}, reintento en {STARTUP_RETRY_DELAY}s: {e}")
+            await asyncio.sleep(STARTUP_RETRY_DELAY)
+    _ready[state].set()
+    logger.info(f"✅ Estado '{state}' cargado")
+
+async def _load_catalog():
+    keys_before = catalog_keys()
+    videos, series = await asyncio.gather(run_storage(load_videos_firestore), run_storage(load_series_firestore))
+    apply_catalog(videos, series, keys_before)
+
+async def _load_chats():
+    global known_chats
+    known_chats = await run_storage(load_known_chats_firestore)
+
+async def load_state(from_snapshot):
+    """Carga en paralelo lo que falta tras abrir el puerto."""
+    if from_snapshot:
+        # El catálogo ya se sirve desde la instantánea; solo se reconcilia
+        catalog = reconcile_catalog()
+    else:
+        catalog = _load_until_ready("catalog", _load_catalog)
+    await asyncio.gather(
+        catalog,
+        _load_until_ready("chats", _load_chats),
+        _load_until_ready("trending", _load_trending),
+    )
+    try:
+        await resume_broadcast_jobs(app_telegram.bot)
+    except Exception as e:
+        logger.error(f"Error reanudando difusiones: {e}")
+
+async def catalog_snapshotter(saved_version):
+    while True:
+        await asyncio.sleep(CATALOG_SNAPSHOT_INTERVAL)
+        if catalog_version == saved_version or not _ready["catalog"].is_set():
+            continue
+        try:
+            saved_version = await save_catalog_snapshot()
+        except Exception as e:
+            logger.error(f"Error guardando la instantánea del catálogo: {e}")
 
 # --- Planes ---
 FREE_LIMIT_VIDEOS = 89
@@ -192,9 +613,61 @@ PLAN_ULTRA_ITEM = {
     "prices": [LabeledPrice("Plan Ultra por 30 días", 50)],
 }
 
+# --- Carga perezosa de usuarios ---
+# user_premium y user_daily_views solo contienen a los usuarios usados recientemente.
+# Cada usuario se lee de Firestore en su primer acceso y se mantiene en un LRU con TTL;
+# varias lecturas simultáneas del mismo usuario comparten una sola consulta.
+USER_CACHE_MAX = int(os.getenv("USER_CACHE_MAX", "5000"))  # usuarios
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "900"))   # segundos
+_loaded_users = OrderedDict()  # {user_id: instante de carga}
+_user_loads = {}               # {user_id: Task} lecturas en curso
+
+def _evict_users():
+    now = time.monotonic()
+    for _ in range(len(_loaded_users)):
+        user_id, loaded_at = next(iter(_loaded_users.items()))
+        if len(_loaded_users) <= USER_CACHE_MAX and now - loaded_at < USER_CACHE_TTL:
+            break
+        if str(user_id) in _dirty[COLLECTION_VIEWS]:
+            # Vistas sin escribir: se conserva hasta después del próximo flush
+            _loaded_users.move_to_end(user_id)
+            continue
+        del _loaded_users[user_id]
+        user_premium.pop(user_id, None)
+        user_daily_views.pop(str(user_id), None)
+
+async def _load_user(user_id):
+    day = views_day
+    premium, views = await run_storage(load_user_state_firestore, user_id, day)
+    # Los planes solo se escriben en transacción al pagar: Firestore es la fuente de verdad
+    if premium is not None:
+        user_premium[user_id] = premium
+    else:
+        user_premium.pop(user_id, None)
+    uid = str(user_id)
+    if day == views_day and views > user_daily_views.get(uid, 0):
+        user_daily_views[uid] = views
+    _loaded_users[user_id] = time.monotonic()
+    _loaded_users.move_to_end(user_id)
+    _evict_users()
+
+async def ensure_user_loaded(user_id):
+    loaded_at = _loaded_users.get(user_id)
+    if loaded_at is not None and time.monotonic() - loaded_at < USER_CACHE_TTL:
+        _loaded_users.move_to_end(user_id)
+        return
+    task = _user_loads.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(_load_user(user_id))
+        _user_loads[user_id] = task
+        task.add_done_callback(lambda _: _user_loads.pop(user_id, None))
+    # shield: si se cancela un handler, la lectura compartida sigue para los demás
+    await asyncio.shield(task)
+
 # --- Control acceso (MODIFICADO) ---
-def is_premium(user_id):
+async def is_premium(user_id):
     # Verifica si el usuario tiene CUALQUIER plan pago activo.
+    await ensure_user_loaded(user_id)
     if user_id in user_premium:
         user_plan_data = user_premium[user_id]
         if isinstance(user_plan_data, dict) and "expire_at" in user_plan_data:
@@ -204,9 +677,9 @@ def is_premium(user_id):
             return user_plan_data > datetime.now(timezone.utc)
     return False
 
-def get_user_plan_type(user_id):
+async def get_user_plan_type(user_id):
     # Obtiene el tipo de plan actual del usuario.
-    if is_premium(user_id):
+    if await is_premium(user_id):
         user_plan_data = user_premium[user_id]
         if isinstance(user_plan_data, dict) and "plan_type" in user_plan_data:
             return user_plan_data["plan_type"]
@@ -214,15 +687,26 @@ def get_user_plan_type(user_id):
         return "plan_ultra" # Asumir Ultra para planes antiguos sin tipo explícito
     return "free"
 
-def can_resend_content(user_id):
+async def can_resend_content(user_id):
     # SOLO el plan "ultra" (o "premium_legacy" para compatibilidad) permite reenviar.
-    plan_type = get_user_plan_type(user_id)
+    plan_type = await get_user_plan_type(user_id)
     return plan_type == "plan_ultra" or plan_type == "premium_legacy"
 
-def can_view_video(user_id):
-    plan_type = get_user_plan_type(user_id)
+def roll_views_day():
+    """Si cambió el día UTC, empieza contadores nuevos en O(1).
+    Las vistas de ayer pendientes de escribir se descartan: ya no cuentan para ningún límite."""
+    global views_day, user_daily_views
     today = str(datetime.utcnow().date())
-    current_views = user_daily_views.get(str(user_id), {}).get(today, 0)
+    if today != views_day:
+        views_day = today
+        user_daily_views = {}
+        _dirty[COLLECTION_VIEWS].clear()
+        _views_flush_event.set() # Dispara la limpieza del día anterior
+
+async def can_view_video(user_id):
+    plan_type = await get_user_plan_type(user_id)
+    roll_views_day()
+    current_views = user_daily_views.get(str(user_id), 0)
 
     if plan_type == "plan_ultra" or plan_type == "premium_legacy":
         return True # Vistas ilimitadas
@@ -231,13 +715,260 @@ def can_view_video(user_id):
     else: # plan_type == "free"
         return current_views < FREE_LIMIT_VIDEOS
 
-async def register_view(user_id):
-    today = str(datetime.utcnow().date())
+async def register_view(user_id, *content_keys):
+    """Cuenta una vista para el límite diario del usuario y para cada clave de contenido."""
+    roll_views_day()
+    register_content_views(content_keys)
     uid = str(user_id)
-    if uid not in user_daily_views:
-        user_daily_views[uid] = {}
-    user_daily_views[uid][today] = user_daily_views[uid].get(today, 0) + 1
-    save_data()
+    count = user_daily_views.get(uid, 0) + 1
+    user_daily_views[uid] = count
+    mark_dirty(COLLECTION_VIEWS, uid)
+    append_views_journal(uid, views_day, count)
+
+    global _pending_views
+    _pending_views += 1
+    if _pending_views >= VIEWS_FLUSH_THRESHOLD:
+        _views_flush_event.set()
+
+# --- Escritura diferida de vistas ---
+# register_view solo actualiza memoria y un diario local; las vistas se envían a
+# Firestore cada VIEWS_FLUSH_INTERVAL segundos o al acumular VIEWS_FLUSH_THRESHOLD.
+# El diario guarda el contador absoluto (no el incremento), así que reaplicarlo
+# con max() es idempotente aunque la escritura ya hubiera llegado a Firestore.
+# Las líneas se acumulan en memoria y cada VIEWS_JOURNAL_SYNC_INTERVAL se escriben con
+# fsync en el pool de hilos: una caída del proceso o del host pierde como mucho ese
+# intervalo de vistas, y el event loop no hace E/S de disco en cada vista.
+VIEWS_FLUSH_INTERVAL = int(os.getenv("VIEWS_FLUSH_INTERVAL", "30"))     # segundos
+VIEWS_FLUSH_THRESHOLD = int(os.getenv("VIEWS_FLUSH_THRESHOLD", "200"))  # vistas pendientes
+VIEWS_JOURNAL_PATH = os.getenv("VIEWS_JOURNAL_PATH", "views_journal.log")
+VIEWS_JOURNAL_FLUSHING = VIEWS_JOURNAL_PATH + ".flushing"
+VIEWS_JOURNAL_SYNC_INTERVAL = float(os.getenv("VIEWS_JOURNAL_SYNC_INTERVAL", "1"))  # segundos
+
+_pending_views = 0
+_views_flush_event = asyncio.Event()
+_journal_buffer = []            # líneas aún no escritas en disco
+_journal_lock = asyncio.Lock()  # serializa escrituras y rotaciones del diario
+
+def append_views_journal(uid, date, count):
+    _journal_buffer.append(json.dumps({"uid": uid, "date": date, "count": count}) + "\n")
+
+def take_journal_buffer():
+    global _journal_buffer
+    lines, _journal_buffer = _journal_buffer, []
+    return lines
+
+def write_views_journal(path, lines):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+def rotate_views_journal(lines):
+    """Mueve el diario actual a VIEWS_JOURNAL_FLUSHING (acumulando si quedó uno de un flush
+    fallido) junto con las líneas aún en memoria."""
+    if os.path.exists(VIEWS_JOURNAL_PATH):
+        with open(VIEWS_JOURNAL_PATH, encoding="utf-8") as src:
+            lines = src.readlines() + lines
+    if lines:
+        write_views_journal(VIEWS_JOURNAL_FLUSHING, lines)
+    if os.path.exists(VIEWS_JOURNAL_PATH):
+        os.remove(VIEWS_JOURNAL_PATH)
+
+def remove_flushed_views_journal():
+    if os.path.exists(VIEWS_JOURNAL_FLUSHING):
+        os.remove(VIEWS_JOURNAL_FLUSHING)
+
+async def sync_views_journal():
+    async with _journal_lock:
+        lines = take_journal_buffer()
+        if not lines:
+            return
+        try:
+            await run_storage(write_views_journal, VIEWS_JOURNAL_PATH, lines)
+        except Exception as e:
+            _journal_buffer[:0] = lines # Se reintenta en el próximo ciclo
+            logger.error(f"Error escribiendo el diario de vistas: {e}")
+
+async def views_journal_syncer():
+    while True:
+        await asyncio.sleep(VIEWS_JOURNAL_SYNC_INTERVAL)
+        await sync_views_journal()
+
+def replay_views_journal():
+    replayed = 0
+    for path in (VIEWS_JOURNAL_FLUSHING, VIEWS_JOURNAL_PATH):
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Línea inválida en diario de vistas {path}: {line!r}")
+                    continue
+                if entry["date"] != views_day:
+                    continue # Días anteriores ya no cuentan para los límites
+                if entry["count"] > user_daily_views.get(entry["uid"], 0):
+                    user_daily_views[entry["uid"]] = entry["count"]
+                    mark_dirty(COLLECTION_VIEWS, entry["uid"])
+                    replayed += 1
+    if replayed:
+        logger.info(f"📒 {replayed} vistas recuperadas del diario local")
+
+async def flush_views():
+    global _pending_views
+    _pending_views = 0
+    taken = take_dirty({COLLECTION_VIEWS})
+    if not taken:
+        return
+    # Sin await entre take_dirty y take_journal_buffer: las líneas rotadas son justo las de
+    # las claves tomadas; las vistas que lleguen después van al diario nuevo
+    lines = take_journal_buffer()
+    async with _journal_lock:
+        try:
+            await run_storage(rotate_views_journal, lines)
+        except Exception as e:
+            _journal_buffer[:0] = lines
+            logger.error(f"Error rotando el diario de vistas: {e}")
+    try:
+        await run_storage(commit_writes, collect_writes(taken))
+    except Exception as e:
+        restore_dirty(taken)
+        logger.error(f"Error guardando vistas, se reintentará: {e}")
+        return
+    # Todo lo que estaba en el diario rotado ya está en Firestore
+    await run_storage(remove_flushed_views_journal)
+
+async def views_flusher():
+    cleaned_day = None
+    while True:
+        try:
+            await asyncio.wait_for(_views_flush_event.wait(), timeout=VIEWS_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _views_flush_event.clear()
+        roll_views_day()
+        await flush_views()
+        await flush_content_views()
+        if cleaned_day != views_day:
+            try:
+                await run_storage(cleanup_stale_views_firestore, views_day)
+                cleaned_day = views_day
+            except Exception as e:
+                logger.error(f"Error limpiando vistas antiguas: {e}")
+
+# --- Vistas por contenido y populares ---
+# Cada vista suma en memoria a su contenido ("video_{pkg_id}" o "serie_{serie_id}", los
+# capítulos cuentan para su serie); los incrementos se envían a Firestore junto con las
+# vistas de usuarios. Un fallo del proceso pierde como mucho un intervalo: el ranking es
+# orientativo y no se lleva diario local. Los rankings del día y de los últimos
+# TRENDING_DAYS días se mantienen incrementalmente con TopK.
+TRENDING_DAYS = 7
+TRENDING_SIZE = int(os.getenv("TRENDING_SIZE", "10"))
+RANKED_PREFIXES = ("video_", "serie_")  # claves que entran en los rankings (= parámetro de /start)
+
+class TopK:
+    """Las k claves con más vistas. Como los contadores solo crecen, cada incremento
+    se resuelve comparando con el último del top, sin ordenar todos los contenidos."""
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.top = []
+        self.version = 0  # cambia solo si cambian los contenidos del top o su orden
+
+    def rebuild(self, counts):
+        self.counts = counts
+        self.top = heapq.nlargest(self.k, counts, key=counts.get)
+        self.version += 1
+
+    def add(self, key, n=1):
+        count = self.counts[key] = self.counts.get(key, 0) + n
+        if key in self.top:
+            before = list(self.top)
+            self.top.sort(key=self.counts.get, reverse=True)
+            if self.top != before:
+                self.version += 1
+        elif len(self.top) < self.k or count > self.counts[self.top[-1]]:
+            self.top.append(key)
+            self.top.sort(key=self.counts.get, reverse=True)
+            del self.top[self.k:]
+            self.version += 1
+
+_content_view_deltas = {}  # {fecha: {clave: incremento}} pendiente de escribir
+_content_views_window = {} # {fecha: {clave: vistas}} de los últimos TRENDING_DAYS días (solo claves del ranking)
+_trending_day = None
+trending_daily = TopK(TRENDING_SIZE)
+trending_weekly = TopK(TRENDING_SIZE)
+
+def trending_dates(today):
+    day = datetime.fromisoformat(today).date()
+    return [str(day - timedelta(days=i)) for i in range(TRENDING_DAYS)]
+
+def rebuild_trending():
+    today = _content_views_window[_trending_day]
+    weekly = {}
+    for counts in _content_views_window.values():
+        for key, n in counts.items():
+            weekly[key] = weekly.get(key, 0) + n
+    trending_daily.rebuild(today)
+    trending_weekly.rebuild(weekly)
+
+def roll_trending_day():
+    """Al cambiar el día UTC se descarta el día más antiguo y se recalculan ambos rankings."""
+    global _trending_day
+    today = str(datetime.utcnow().date())
+    if today == _trending_day:
+        return
+    _trending_day = today
+    dates = trending_dates(today)
+    for date in list(_content_views_window):
+        if date not in dates:
+            del _content_views_window[date]
+    _content_views_window.setdefault(today, {})
+    rebuild_trending()
+
+def register_content_views(keys):
+    if not keys:
+        return
+    roll_trending_day()
+    deltas = _content_view_deltas.setdefault(_trending_day, {})
+    for key in keys:
+        if not key.startswith(RANKED_PREFIXES):
+            continue # Solo se guardan las claves que se leen para los rankings
+        deltas[key] = deltas.get(key, 0) + 1
+        # trending_daily.counts es _content_views_window[hoy]
+        trending_daily.add(key)
+        trending_weekly.add(key)
+
+async def _load_trending():
+    roll_trending_day()
+    loaded = await run_storage(load_content_views_firestore, trending_dates(_trending_day))
+    # Hasta que termine la carga no se escribe nada (flush_content_views espera a este
+    # estado), así lo que hay en memoria son solo vistas nuevas y se puede sumar.
+    for date, counts in loaded.items():
+        if date not in _content_views_window:
+            continue
+        window = _content_views_window[date]
+        for key, n in counts.items():
+            if key.startswith(RANKED_PREFIXES):
+                window[key] = window.get(key, 0) + n
+    rebuild_trending()
+
+async def flush_content_views():
+    global _content_view_deltas
+    if not _content_view_deltas or not _ready["trending"].is_set():
+        return
+    deltas, _content_view_deltas = _content_view_deltas, {}
+    try:
+        await run_storage(commit_content_view_increments, deltas)
+    except Exception as e:
+        # Se devuelven a la cola pendiente para el próximo flush
+        for date, counts in deltas.items():
+            pending = _content_view_deltas.setdefault(date, {})
+            for key, n in counts.items():
+                pending[key] = pending.get(key, 0) + n
+        logger.error(f"Error guardando vistas por contenido, se reintentará: {e}")
 
 # --- Canales para verificación ---
 CHANNELS = {
@@ -246,6 +977,8 @@ CHANNELS = {
 }
 
 # --- Menú principal ---
+# Los teclados de Telegram son inmutables en PTB 20: los estáticos se construyen una vez y se reutilizan
+@functools.lru_cache(maxsize=None)
 def get_main_menu():
     return InlineKeyboardMarkup(
         [
@@ -261,6 +994,9 @@ def get_main_menu():
                 InlineKeyboardButton("📽️ peliculas", url="https://t.me/+rvYUEq-c96kzODE0"),
                 InlineKeyboardButton("🎬 series", url="https://t.me/+eYI6JZq72o4xNWFh"),
             ],
+            [
+                InlineKeyboardButton("🔥 Populares", callback_data="populares"),
+            ],
             [
                 InlineKeyboardButton("💎 Planes", callback_data="planes"),
                ],
@@ -274,40 +1010,328 @@ def get_main_menu():
         ]
     )
 
+# Botón para comprar planes al alcanzar el límite diario
+LIMIT_REACHED_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("💎 Comprar Planes", callback_data="planes")]])
+
+PLANES_TEXT = (
+    f"💎 *Planes disponibles:*\n\n"
+    f"🔹 Free – Hasta {FREE_LIMIT_VIDEOS} videos por día.\n\n"
+    "🔸 *Plan Pro*\n"
+    "Precio: 25 estrellas\n"
+    "Beneficios: 50 videos diarios, sin reenvíos ni compartir.\n\n"
+    "🔸 *Plan Ultra*\n"
+    "Precio: 50 estrellas\n"
+    "Beneficios: Videos y reenvíos ilimitados, sin restricciones.\n"
+)
+PLANES_MARKUP = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton("💸 Comprar Plan Pro (25 ⭐)", callback_data="comprar_pro")],
+        [InlineKeyboardButton("💸 Comprar Plan Ultra (50 ⭐)", callback_data="comprar_ultra")],
+        [InlineKeyboardButton("🔙 Volver", callback_data="menu_principal")],
+    ]
+)
+
 # --- Función auxiliar para generar botones de capítulos en cuadrícula ---
-def generate_chapter_buttons(serie_id, num_chapters, chapters_per_row=5):
+# Las series largas se muestran por páginas de CHAPTERS_PER_PAGE capítulos, así el
+# teclado tiene el mismo tamaño sea cual sea la longitud de la serie. Navegación:
+# sp_{serie_id}_{página} (⏮ primera, ◀️ anterior, ▶️ siguiente, ⏭ última).
+CHAPTERS_PER_ROW = 5
+CHAPTERS_PER_PAGE = int(os.getenv("CHAPTERS_PER_PAGE", "25"))
+
+# Páginas ya construidas: {(serie_id, num_chapters, page): InlineKeyboardMarkup}
+_chapter_grid_cache = {}
+
+def chapter_page_count(num_chapters):
+    return max(1, -(-num_chapters // CHAPTERS_PER_PAGE))
+
+def chapter_page(index):
+    """Página que contiene el capítulo index."""
+    return index // CHAPTERS_PER_PAGE
+
+def invalidate_chapter_grids(serie_id=None):
+    """Descarta las cuadrículas de una serie (o todas si serie_id es None)."""
+    if serie_id is None:
+        _chapter_grid_cache.clear()
+        return
+    for key in [key for key in _chapter_grid_cache if key[0] == serie_id]:
+        del _chapter_grid_cache[key]
+
+async def get_chapter_video(serie_id, index):
+    """file_id de un capítulo: desde la caché o leyendo un solo documento de Firestore."""
+    key = (serie_id, index)
+    video_id = _chapter_cache.get(key)
+    if video_id is not None:
+        _chapter_cache.move_to_end(key)
+        return video_id
+    legacy = series_data.get(serie_id, {}).get("capitulos")
+    if legacy is not None:
+        # Serie antigua aún sin migrar: los capítulos siguen en la cabecera
+        return legacy[index] if 0 <= index < len(legacy) else None
+    video_id = await run_storage(load_chapter_firestore, serie_id, index)
+    if video_id is not None:
+        cache_chapter(serie_id, index, video_id)
+    return video_id
+
+def cache_chapter(serie_id, index, video_id):
+    _chapter_cache[(serie_id, index)] = video_id
+    _chapter_cache.move_to_end((serie_id, index))
+    for _ in range(len(_chapter_cache) - CHAPTER_CACHE_MAX):
+        key = next(iter(_chapter_cache))
+        if key in _dirty[SUBCOLLECTION_CHAPTERS]:
+            # Capítulo sin escribir: se conserva hasta el próximo save_data_async()
+            _chapter_cache.move_to_end(key)
+            continue
+        del _chapter_cache[key]
+
+def generate_chapter_buttons(serie_id, num_chapters, page=0):
+    page = min(max(page, 0), chapter_page_count(num_chapters) - 1)
+    key = (serie_id, num_chapters, page)
+    markup = _chapter_grid_cache.get(key)
+    if markup is None:
+        markup = _chapter_grid_cache[key] = _build_chapter_buttons(serie_id, num_chapters, page)
+    return markup
+
+def _build_chapter_buttons(serie_id, num_chapters, page):
     buttons = []
     row = []
-    for i in range(num_chapters):
+    first = page * CHAPTERS_PER_PAGE
+    for i in range(first, min(num_chapters, first + CHAPTERS_PER_PAGE)):
         row.append(InlineKeyboardButton(str(i + 1), callback_data=f"cap_{serie_id}_{i}"))
-        if len(row) == chapters_per_row:
+        if len(row) == CHAPTERS_PER_ROW:
             buttons.append(row)
             row = []
     if row: # Añadir la última fila si no está completa
         buttons.append(row)
-    
+
+    pages = chapter_page_count(num_chapters)
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⏮", callback_data=f"sp_{serie_id}_0"))
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"sp_{serie_id}_{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="noop"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"sp_{serie_id}_{page + 1}"))
+            nav.append(InlineKeyboardButton("⏭", callback_data=f"sp_{serie_id}_{pages - 1}"))
+        buttons.append(nav)
+
     # Añadir botón "Volver al menú principal" al final
     buttons.append([InlineKeyboardButton("🔙 Volver al menú principal", callback_data="menu_principal")])
     return InlineKeyboardMarkup(buttons)
 
+# --- Identidad del bot ---
+def get_bot_username():
+    # app_telegram.initialize() llama a get_me() una sola vez y guarda el resultado
+    return app_telegram.bot.username
+
+def build_deep_link(start_param):
+    return f"https://t.me/{get_bot_username()}?start={start_param}"
+
+# --- Búsqueda inline ---
+# "@bot término" busca en un índice invertido en memoria sobre los captions de los
+# videos y el título + caption de las series. Los términos se guardan sin acentos y en
+# minúsculas en una lista ordenada, así un prefijo se resuelve con bisect sin recorrer
+# el catálogo. Requiere activar el modo inline del bot con /setinline en BotFather.
+INLINE_PAGE_SIZE = 20          # resultados por respuesta (Telegram admite hasta 50)
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "60"))  # segundos de caché en Telegram
+INLINE_QUERY_CACHE_MAX = 500   # consultas recientes con su lista de resultados
+WORD_RE = re.compile(r"\w+")
+
+def fold_text(text):
+    """Minúsculas y sin acentos: "Canción" -> "cancion"."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def search_terms(text):
+    return set(WORD_RE.findall(fold_text(text or "")))
+
+class SearchIndex:
+    """Índice invertido {término: {clave}} con claves ("video", pkg_id) o ("serie", serie_id)."""
+
+    def __init__(self):
+        self._postings = {}     # {término: set(claves)}
+        self._terms = []        # términos ordenados, para buscar por prefijo
+        self._doc_terms = {}    # {clave: set(términos)}, para reindexar
+        self._queries = OrderedDict()  # {términos de la consulta: [claves ordenadas]}
+
+    def __len__(self):
+        return len(self._doc_terms)
+
+    @classmethod
+    def build(cls, videos, series):
+        """Índice completo: los términos se ordenan una sola vez al final."""
+        index = cls()
+        for pkg_id, pkg in videos.items():
+            index._index(("video", pkg_id), video_search_text(pkg))
+        for serie_id, serie in series.items():
+            index._index(("serie", serie_id), serie_search_text(serie))
+        index._terms = sorted(index._postings)
+        return index
+
+    def _index(self, key, text):
+        terms = search_terms(text)
+        self._doc_terms[key] = terms
+        new_terms = []
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = set()
+                new_terms.append(term)
+            postings.add(key)
+        return new_terms
+
+    def add(self, key, text):
+        """Alta o actualización incremental de un contenido."""
+        self.remove(key)
+        for term in self._index(key, text):
+            bisect.insort(self._terms, term)
+        self._queries.clear()
+
+    def remove(self, key):
+        for term in self._doc_terms.pop(key, ()):
+            postings = self._postings[term]
+            postings.discard(key)
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect.bisect_left(self._terms, term)]
+        self._queries.clear()
+
+    def _prefix_matches(self, prefix):
+        matches = set()
+        i = bisect.bisect_left(self._terms, prefix)
+        while i < len(self._terms) and self._terms[i].startswith(prefix):
+            matches |= self._postings[self._terms[i]]
+            i += 1
+        return matches
+
+    def search(self, query):
+        """Claves que contienen todos los términos (el último como prefijo), las más nuevas primero."""
+        words = WORD_RE.findall(fold_text(query))
+        if not words:
+            return []
+        cache_key = tuple(words)
+        cached = self._queries.get(cache_key)
+        if cached is not None:
+            self._queries.move_to_end(cache_key)
+            return cached
+        result = None
+        # Se empieza por los términos completos (listas más cortas) y el prefijo al final
+        for word in sorted(words[:-1], key=lambda w: len(self._postings.get(w, ()))):
+            postings = self._postings.get(word, set())
+            result = set(postings) if result is None else result & postings
+            if not result:
+                break
+        if result is None or result:
+            matches = self._prefix_matches(words[-1])
+            result = matches if result is None else result & matches
+        # Los ids son marcas de tiempo: orden descendente = contenido más reciente primero
+        ranked = sorted(result, key=lambda key: key[1], reverse=True)
+        self._queries[cache_key] = ranked
+        if len(self._queries) > INLINE_QUERY_CACHE_MAX:
+            self._queries.popitem(last=False)
+        return ranked
+
+def video_search_text(pkg):
+    return pkg.get("caption", "")
+
+def serie_search_text(serie):
+    return f"{serie.get('title', '')} {serie.get('caption', '')}"
+
+search_index = SearchIndex()
+
+def index_video(pkg_id):
+    search_index.add(("video", pkg_id), video_search_text(content_packages[pkg_id]))
+
+def index_serie(serie_id):
+    search_index.add(("serie", serie_id), serie_search_text(series_data[serie_id]))
+
+def rebuild_search_index():
+    global search_index
+    started = time.perf_counter()
+    search_index = SearchIndex.build(content_packages, series_data)
+    logger.info(f"🔎 Índice de búsqueda: {len(search_index)} contenidos en {time.perf_counter() - started:.2f}s")
+
+def inline_result(key):
+    kind, item_id = key
+    if kind == "video":
+        item = content_packages.get(item_id)
+        start_param = f"video_{item_id}"
+        title = (item or {}).get("caption", "").split("\n")[0]
+    else:
+        item = series_data.get(item_id)
+        start_param = f"serie_{item_id}"
+        title = (item or {}).get("title", "")
+    if not item:
+        return None
+    return InlineQueryResultCachedPhoto(
+        id=f"{kind}_{item_id}",
+        photo_file_id=item["photo_id"],
+        title=title[:64],
+        caption=item.get("caption", "")[:1024],
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("➡️ Ver contenido", url=build_deep_link(start_param))]]),
+    )
+
+@requires("catalog")
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    inline_query = update.inline_query
+    keys = search_index.search(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    page = keys[offset:offset + INLINE_PAGE_SIZE]
+    results = [result for result in map(inline_result, page) if result is not None]
+    next_offset = str(offset + INLINE_PAGE_SIZE) if offset + INLINE_PAGE_SIZE < len(keys) else ""
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
 # --- Función auxiliar para verificar suscripción a canales ---
+# Solo se cachean resultados positivos: {(user_id, canal): instante de expiración}
+SUBSCRIPTION_CACHE_TTL = int(os.getenv("SUBSCRIPTION_CACHE_TTL", "600"))        # segundos
+SUBSCRIPTION_CACHE_MAX = int(os.getenv("SUBSCRIPTION_CACHE_MAX", "20000"))      # entradas
+_subscription_cache = OrderedDict()
+
+def _subscription_cached(user_id, username):
+    key = (user_id, username)
+    expires = _subscription_cache.get(key)
+    if expires is None:
+        return False
+    if expires < time.monotonic():
+        del _subscription_cache[key]
+        return False
+    return True
+
+def _cache_subscription(user_id, username):
+    key = (user_id, username)
+    _subscription_cache[key] = time.monotonic() + SUBSCRIPTION_CACHE_TTL
+    _subscription_cache.move_to_end(key)
+    while len(_subscription_cache) > SUBSCRIPTION_CACHE_MAX:
+        _subscription_cache.popitem(last=False) # Expulsar la entrada más antigua
+
+def invalidate_subscription_cache(user_id):
+    for username in CHANNELS.values():
+        _subscription_cache.pop((user_id, username), None)
+
+async def _is_channel_member(user_id, username, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        member = await context.bot.get_chat_member(chat_id=username, user_id=user_id)
+    except Exception as e:
+        logger.warning(f"Error verificando canal {username} para user {user_id}: {e}")
+        return False # Asumir no unido si hay error
+    if member.status not in ["member", "administrator", "creator"]:
+        return False
+    _cache_subscription(user_id, username)
+    return True
+
 async def check_channel_subscription(user_id, context: ContextTypes.DEFAULT_TYPE):
-    not_joined = []
-    for name, username in CHANNELS.items():
-        try:
-            member = await context.bot.get_chat_member(chat_id=username, user_id=user_id)
-            if member.status not in ["member", "administrator", "creator"]:
-                not_joined.append(username)
-        except Exception as e:
-            logger.warning(f"Error verificando canal {username} para user {user_id}: {e}")
-            not_joined.append(username) # Asumir no unido si hay error
-    return not_joined
+    # Los canales sin resultado en caché se consultan en paralelo
+    pending = [username for username in CHANNELS.values() if not _subscription_cached(user_id, username)]
+    if not pending:
+        return []
+    results = await asyncio.gather(*(_is_channel_member(user_id, username, context) for username in pending))
+    return [username for username, joined in zip(pending, results) if not joined]
 
 # --- Handlers ---
+@requires("catalog")
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args
     user_id = update.effective_user.id
-    bot_username = (await context.bot.get_me()).username
 
     # Verificar suscripción a canales al inicio
     not_joined_channels = await check_channel_subscription(user_id, context)
@@ -362,19 +1386,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Video no disponible.")
             return
 
-        if can_view_video(user_id):
-            await register_view(user_id)
+        if await can_view_video(user_id):
+            await register_view(user_id, f"video_{pkg_id}")
             title_caption = pkg.get("caption", "🎬 Aquí tienes el video completo.")
             await update.message.reply_video(
                 video=pkg["video_id"],
                 caption=title_caption,
-                protect_content=not can_resend_content(user_id)
+                protect_content=not await can_resend_content(user_id)
             )
         else:
             await update.message.reply_text(
                 f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} videos.\n"
                 "💎 Por favor, considera comprar un plan para acceso ilimitado.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Comprar Planes", callback_data="planes")]]),
+                reply_markup=LIMIT_REACHED_MARKUP,
             )
             return
 
@@ -387,22 +1411,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # APLICACIÓN DE LA SEGURIDAD PARA SERIES AQUÍ
-        if not can_view_video(user_id): # Verifica si tiene vistas disponibles
+        if not await can_view_video(user_id): # Verifica si tiene vistas disponibles
             await update.message.reply_text(
                 f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} vistas para series/videos.\n"
                 "💎 Por favor, considera comprar un plan para acceso ilimitado.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Comprar Planes", callback_data="planes")]]),
+                reply_markup=LIMIT_REACHED_MARKUP,
             )
             return
 
         # Si puede ver, mostrar capítulos
-        capitulos = serie.get("capitulos", [])
-        if not capitulos:
+        num_capitulos = serie.get("num_capitulos", 0)
+        if not num_capitulos:
             await update.message.reply_text("❌ Esta serie no tiene capítulos disponibles aún.")
             return
         
         # Usar la nueva función para generar los botones de los capítulos
-        markup = generate_chapter_buttons(serie_id, len(capitulos))
+        markup = generate_chapter_buttons(serie_id, num_capitulos)
 
         await update.message.reply_photo(
             photo=serie["photo_id"],
@@ -420,6 +1444,8 @@ async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = query.from_user.id
     
+    # Forzar una comprobación real contra Telegram
+    invalidate_subscription_cache(user_id)
     not_joined = await check_channel_subscription(user_id, context)
 
     if not not_joined:
@@ -428,263 +1454,753 @@ async def verify(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await query.edit_message_text("❌ Aún no estás suscrito a:\n" + "\n".join(not_joined))
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# --- Enrutador de callbacks ---
+class CallbackRouter:
+    """Resuelve query.data con rutas exactas (dict) y por prefijo, con argumentos tipados.
+    Lleva por ruta el número de llamadas, errores y un histograma de latencia."""
+
+    LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # segundos
+
+    def __init__(self):
+        self._exact = {}     # {data: handler}
+        self._prefixes = {}  # {prefijo: (handler, tipos)}
+        self.metrics = {}    # {ruta: {"calls", "errors", "total", "buckets"}}
+
+    def exact(self, data):
+        def decorator(handler):
+            self._exact[data] = handler
+            return handler
+        return decorator
+
+    def prefix(self, prefix, *types):
+        """Ruta por prefijo: el resto de query.data se separa por "_" y se convierte con types."""
+        def decorator(handler):
+            self._prefixes[prefix] = (handler, types)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        """Devuelve (ruta, handler, args) o None. Solo se prueban los cortes en cada "_"."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, handler, ()
+        match = None
+        cut = data.find("_")
+        while cut != -1:
+            if data[:cut + 1] in self._prefixes:
+                match = data[:cut + 1] # Gana el prefijo más largo
+            cut = data.find("_", cut + 1)
+        if match is None:
+            return None
+        handler, types = self._prefixes[match]
+        # rsplit: el primer campo puede contener "_", los últimos son los tipados
+        raw_args = data[len(match):].rsplit("_", len(types) - 1) if types else []
+        if len(raw_args) != len(types):
+            return None
+        try:
+            args = tuple(cast(value) for cast, value in zip(types, raw_args))
+        except ValueError:
+            return None
+        return match, handler, args
+
+    def _observe(self, route, elapsed, failed):
+        stats = self.metrics.get(route)
+        if stats is None:
+            stats = self.metrics[route] = {
+                "calls": 0,
+                "errors": 0,
+                "total": 0.0,
+                "buckets": {str(bound): 0 for bound in self.LATENCY_BUCKETS + ("inf",)},
+            }
+        stats["calls"] += 1
+        stats["errors"] += failed
+        stats["total"] += elapsed
+        for bound in self.LATENCY_BUCKETS:
+            if elapsed <= bound:
+                stats["buckets"][str(bound)] += 1
+                break
+        else:
+            stats["buckets"]["inf"] += 1
+
+    async def dispatch(self, query, context):
+        resolved = self.resolve(query.data or "")
+        if resolved is None:
+            logger.warning(f"Callback sin ruta: {query.data!r}")
+            return
+        route, handler, args = resolved
+        started = time.perf_counter()
+        failed = True
+        try:
+            await handler(query, context, *args)
+            failed = False
+        finally:
+            self._observe(route, time.perf_counter() - started, failed)
+
+callback_router = CallbackRouter()
+
+@callback_router.exact("planes")
+async def cb_planes(query, context):
+    await query.message.reply_text(PLANES_TEXT, parse_mode="Markdown", reply_markup=PLANES_MARKUP)
+
+@callback_router.exact("comprar_pro")
+async def cb_comprar_pro(query, context):
+    user_id = query.from_user.id
+    if await is_premium(user_id):
+        exp_date = user_premium[user_id].get("expire_at", datetime.now(timezone.utc)).strftime("%Y-%m-%d") # MODIFICADO
+        await query.message.reply_text(f"✅ Ya tienes un plan activo hasta {exp_date}.")
+        return
+    await context.bot.send_invoice(
+        chat_id=query.message.chat_id,
+        title=PLAN_PRO_ITEM["title"],
+        description=PLAN_PRO_ITEM["description"],
+        payload=PLAN_PRO_ITEM["payload"],
+        provider_token=PROVIDER_TOKEN,
+        currency=PLAN_PRO_ITEM["currency"],
+        prices=PLAN_PRO_ITEM["prices"],
+        start_parameter="buy-plan-pro",
+    )
+
+@callback_router.exact("comprar_ultra")
+async def cb_comprar_ultra(query, context):
+    user_id = query.from_user.id
+    if await is_premium(user_id):
+        exp_date = user_premium[user_id].get("expire_at", datetime.now(timezone.utc)).strftime("%Y-%m-%d") # MODIFICADO
+        await query.message.reply_text(f"✅ Ya tienes un plan activo hasta {exp_date}.")
+        return
+    await context.bot.send_invoice(
+        chat_id=query.message.chat_id,
+        title=PLAN_ULTRA_ITEM["title"],
+        description=PLAN_ULTRA_ITEM["description"],
+        payload=PLAN_ULTRA_ITEM["payload"],
+        provider_token=PROVIDER_TOKEN,
+        currency=PLAN_ULTRA_ITEM["currency"],
+        prices=PLAN_ULTRA_ITEM["prices"],
+        start_parameter="buy-plan-ultra",
+    )
+
+@callback_router.exact("perfil")
+async def cb_perfil(query, context):
     user = query.from_user
     user_id = user.id
-    data = query.data
-
-    if data == "planes":
-        texto_planes = (
-            f"💎 *Planes disponibles:*\n\n"
-            f"🔹 Free – Hasta {FREE_LIMIT_VIDEOS} videos por día.\n\n"
-            "🔸 *Plan Pro*\n"
-            "Precio: 25 estrellas\n"
-            "Beneficios: 50 videos diarios, sin reenvíos ni compartir.\n\n"
-            "🔸 *Plan Ultra*\n"
-            "Precio: 50 estrellas\n"
-            "Beneficios: Videos y reenvíos ilimitados, sin restricciones.\n"
-        )
-        botones_planes = InlineKeyboardMarkup(
-            [
-                [InlineKeyboardButton("💸 Comprar Plan Pro (25 ⭐)", callback_data="comprar_pro")],
-                [InlineKeyboardButton("💸 Comprar Plan Ultra (50 ⭐)", callback_data="comprar_ultra")],
-                [InlineKeyboardButton("🔙 Volver", callback_data="menu_principal")],
-            ]
-        )
-        await query.message.reply_text(texto_planes, parse_mode="Markdown", reply_markup=botones_planes)
+    plan_type = await get_user_plan_type(user_id)
+    exp_date_str = "N/A"
+    if await is_premium(user_id):
+        # user_premium[user_id] ahora es un diccionario como {"expire_at": datetime, "plan_type": str}
+        user_plan_data = user_premium[user_id]
+        if isinstance(user_plan_data, dict) and "expire_at" in user_plan_data:
+            exp_date = user_plan_data.get("expire_at")
+            if exp_date:
+                exp_date_str = exp_date.strftime('%Y-%m-%d')
+        # Manejo de compatibilidad para usuarios antiguos que solo tenían fecha en user_premium
+        elif isinstance(user_plan_data, datetime):
+            exp_date_str = user_plan_data.strftime('%Y-%m-%d')
 
-    elif data == "comprar_pro":
-        if is_premium(user_id):
-            exp_date = user_premium[user_id].get("expire_at", datetime.now(timezone.utc)).strftime("%Y-%m-%d") # MODIFICADO
-            await query.message.reply_text(f"✅ Ya tienes un plan activo hasta {exp_date}.")
-            return
-        await context.bot.send_invoice(
-            chat_id=query.message.chat_id,
-            title=PLAN_PRO_ITEM["title"],
-            description=PLAN_PRO_ITEM["description"],
-            payload=PLAN_PRO_ITEM["payload"],
-            provider_token=PROVIDER_TOKEN,
-            currency=PLAN_PRO_ITEM["currency"],
-            prices=PLAN_PRO_ITEM["prices"],
-            start_parameter="buy-plan-pro",
-        )
 
-    elif data == "comprar_ultra":
-        if is_premium(user_id):
-            exp_date = user_premium[user_id].get("expire_at", datetime.now(timezone.utc)).strftime("%Y-%m-%d") # MODIFICADO
-            await query.message.reply_text(f"✅ Ya tienes un plan activo hasta {exp_date}.")
-            return
-        await context.bot.send_invoice(
-            chat_id=query.message.chat_id,
-            title=PLAN_ULTRA_ITEM["title"],
-            description=PLAN_ULTRA_ITEM["description"],
-            payload=PLAN_ULTRA_ITEM["payload"],
-            provider_token=PROVIDER_TOKEN,
-            currency=PLAN_ULTRA_ITEM["currency"],
-            prices=PLAN_ULTRA_ITEM["prices"],
-            start_parameter="buy-plan-ultra",
-        )
+    await query.message.reply_text(
+        f"🧑 Perfil:\n• {user.full_name}\n• @{user.username or 'Sin usuario'}\n"
+        f"• ID: {user_id}\n• Plan: {plan_type.replace('plan_', '').replace('premium_legacy', 'Ultra').capitalize()}\n• Expira: {exp_date_str}",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver", callback_data="planes")]]),
+    )
 
-    elif data == "perfil":
-        plan_type = get_user_plan_type(user_id)
-        exp_date_str = "N/A"
-        if is_premium(user_id):
-            # user_premium[user_id] ahora es un diccionario como {"expire_at": datetime, "plan_type": str}
-            user_plan_data = user_premium[user_id]
-            if isinstance(user_plan_data, dict) and "expire_at" in user_plan_data:
-                exp_date = user_plan_data.get("expire_at")
-                if exp_date:
-                    exp_date_str = exp_date.strftime('%Y-%m-%d')
-            # Manejo de compatibilidad para usuarios antiguos que solo tenían fecha en user_premium
-            elif isinstance(user_plan_data, datetime):
-                exp_date_str = user_plan_data.strftime('%Y-%m-%d')
+@callback_router.exact("menu_principal")
+async def cb_menu_principal(query, context):
+    await query.message.reply_text("📋 Menú principal:", reply_markup=get_main_menu())
 
+# Populares del día o de la semana: el texto y el teclado se construyen solo cuando cambia
+# el top (TopK.version) o el catálogo; el resto de pulsaciones reutiliza la misma respuesta.
+TRENDING_VIEWS = {
+    "populares": ("🔥 *Populares de hoy*", trending_daily, ("🗓️ Ver la semana", "populares_semana")),
+    "populares_semana": (f"🔥 *Populares de los últimos {TRENDING_DAYS} días*", trending_weekly, ("📅 Ver hoy", "populares")),
+}
+_trending_render_cache = {}  # {vista: (versión del top, versión del catálogo, markup, hay entradas)}
+
+def content_title(key):
+    kind, item_id = key.split("_", 1)
+    if kind == "video":
+        pkg = content_packages.get(item_id)
+        return pkg.get("caption", "").split("\n")[0] if pkg else None
+    serie = series_data.get(item_id)
+    return f"📺 {serie['title']}" if serie else None
+
+def render_trending(view):
+    title, ranking, (toggle_text, toggle_data) = TRENDING_VIEWS[view]
+    cached = _trending_render_cache.get(view)
+    if cached is not None and cached[:2] == (ranking.version, catalog_version):
+        return title, cached[2], cached[3]
+    buttons = []
+    for key in ranking.top:
+        label = content_title(key)
+        if label: # El contenido puede haberse eliminado del catálogo
+            buttons.append([InlineKeyboardButton(f"{len(buttons) + 1}. {label[:40]}", url=build_deep_link(key))])
+    has_entries = len(buttons) > 0
+    buttons.append([InlineKeyboardButton(toggle_text, callback_data=toggle_data)])
+    buttons.append([InlineKeyboardButton("🔙 Volver al menú principal", callback_data="menu_principal")])
+    markup = InlineKeyboardMarkup(buttons)
+    _trending_render_cache[view] = (ranking.version, catalog_version, markup, has_entries)
+    return title, markup, has_entries
+
+@callback_router.exact("populares")
+@callback_router.exact("populares_semana")
+async def cb_populares(query, context):
+    if not _ready["trending"].is_set():
+        await _ready["trending"].wait()
+    roll_trending_day()
+    title, markup, has_entries = render_trending(query.data)
+    if not has_entries:
+        title += "\n\nAún no hay vistas registradas."
+    await query.message.reply_text(title, parse_mode="Markdown", reply_markup=markup)
+
+PLACEHOLDER_REPLIES = {
+    "audio_libros": "🎧 Aquí estará el contenido de Audio Libros.",
+    "libro_pdf": "📚 Aquí estará el contenido de Libro PDF.",
+    "chat_pedido": "💬 Aquí puedes hacer tu pedido en el chat.",
+    "cursos": "🎓 Aquí estarán los cursos disponibles.",
+}
 
+async def cb_placeholder(query, context):
+    await query.message.reply_text(PLACEHOLDER_REPLIES[query.data])
+
+for placeholder_data in PLACEHOLDER_REPLIES:
+    callback_router.exact(placeholder_data)(cb_placeholder)
+
+# Reproducir el video individual
+@callback_router.prefix("play_video_", str)
+async def cb_play_video(query, context, pkg_id):
+    user_id = query.from_user.id
+    pkg = content_packages.get(pkg_id)
+    if not pkg or "video_id" not in pkg:
+        await query.message.reply_text("❌ Video no disponible.")
+        return
+
+    # Verificación de seguridad (similar a 'start' handler)
+    not_joined_channels = await check_channel_subscription(user_id, context)
+    if not_joined_channels:
         await query.message.reply_text(
-            f"🧑 Perfil:\n• {user.full_name}\n• @{user.username or 'Sin usuario'}\n"
-            f"• ID: {user_id}\n• Plan: {plan_type.replace('plan_', '').replace('premium_legacy', 'Ultra').capitalize()}\n• Expira: {exp_date_str}",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver", callback_data="planes")]]),
+            "🔒 Para ver este contenido debes unirte a los canales.",
+            reply_markup=InlineKeyboardMarkup(
+                [
+                    [
+                        InlineKeyboardButton(
+                            "🔗 Unirse a canal 1", url=f"https://t.me/{CHANNELS['canal_1'][1:]}"
+                        )
+                    ],
+                    [
+                        InlineKeyboardButton(
+                            "🔗 Unirse a canal 2", url=f"https://t.me/{CHANNELS['canal_2'][1:]}"
+                        )
+                    ],
+                    [InlineKeyboardButton("✅ Verificar suscripción", callback_data="verify")],
+                ]
+            ),
         )
+        return
 
-    elif data == "menu_principal":
-        await query.message.reply_text("📋 Menú principal:", reply_markup=get_main_menu())
+    if await can_view_video(user_id):
+        await register_view(user_id, f"video_{pkg_id}")
+        title_caption = pkg.get("caption", "🎬 Aquí tienes el video completo.")
 
-    elif data == "audio_libros":
-        await query.message.reply_text("🎧 Aquí estará el contenido de Audio Libros.")
-    elif data == "libro_pdf":
-        await query.message.reply_text("📚 Aquí estará el contenido de Libro PDF.")
-    elif data == "chat_pedido":
-        await query.message.reply_text("💬 Aquí puedes hacer tu pedido en el chat.")
-    elif data == "cursos":
-        await query.message.reply_text("🎓 Aquí estarán los cursos disponibles.")
-
-    # Manejo del callback para reproducir el video individual
-    elif data.startswith("play_video_"):
-        pkg_id = data.split("_")[2]
-        pkg = content_packages.get(pkg_id)
-        if not pkg or "video_id" not in pkg:
-            await query.message.reply_text("❌ Video no disponible.")
-            return
+        # Añadir el botón "Volver al menú principal"
+        reply_markup_video = InlineKeyboardMarkup(
+            [
+                [InlineKeyboardButton("🔙 Volver al menú principal", callback_data="menu_principal")]
+            ]
+        )
 
-        # Verificación de seguridad (similar a 'start' handler)
-        not_joined_channels = await check_channel_subscription(user_id, context)
-        if not_joined_channels:
-            await query.message.reply_text(
-                "🔒 Para ver este contenido debes unirte a los canales.",
-                reply_markup=InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "🔗 Unirse a canal 1", url=f"https://t.me/{CHANNELS['canal_1'][1:]}"
-                            )
-                        ],
-                        [
-                            InlineKeyboardButton(
-                                "🔗 Unirse a canal 2", url=f"https://t.me/{CHANNELS['canal_2'][1:]}"
-                            )
-                        ],
-                        [InlineKeyboardButton("✅ Verificar suscripción", callback_data="verify")],
-                    ]
-                ),
-            )
-            return
+        await query.message.reply_video(
+            video=pkg["video_id"],
+            caption=title_caption,
+            protect_content=not await can_resend_content(user_id),
+            reply_markup=reply_markup_video # Asignar el nuevo markup
+        )
+        await query.message.delete() # Eliminar el mensaje anterior
+    else:
+        await query.answer("🚫 Has alcanzado tu límite diario de videos. Compra un plan para más acceso.", show_alert=True)
+        await query.message.reply_text(
+            f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} videos.\n"
+            "💎 Por favor, considera comprar un plan para acceso ilimitado.",
+            reply_markup=LIMIT_REACHED_MARKUP,
+        )
 
-        if can_view_video(user_id):
-            await register_view(user_id)
-            title_caption = pkg.get("caption", "🎬 Aquí tienes el video completo.")
+# Mostrar video capítulo con navegación (series)
+@callback_router.prefix("cap_", str, int)
+async def cb_chapter(query, context, serie_id, index):
+    user_id = query.from_user.id
+    serie = series_data.get(serie_id)
 
-            # Añadir el botón "Volver al menú principal"
-            reply_markup_video = InlineKeyboardMarkup(
-                [
-                    [InlineKeyboardButton("🔙 Volver al menú principal", callback_data="menu_principal")]
-                ]
-            )
+    if not serie or not serie.get("num_capitulos"):
+        await query.message.reply_text("❌ Serie o capítulos no disponibles.")
+        return
 
-            await query.message.reply_video(
-                video=pkg["video_id"],
-                caption=title_caption,
-                protect_content=not can_resend_content(user_id),
-                reply_markup=reply_markup_video # Asignar el nuevo markup
-            )
-            await query.message.delete() # Eliminar el mensaje anterior
-        else:
-            await query.answer("🚫 Has alcanzado tu límite diario de videos. Compra un plan para más acceso.", show_alert=True)
-            await query.message.reply_text(
-                f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} videos.\n"
-                "💎 Por favor, considera comprar un plan para acceso ilimitado.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Comprar Planes", callback_data="planes")]]),
-            )
+    total = serie["num_capitulos"]
+    if index < 0 or index >= total:
+        await query.message.reply_text("❌ Capítulo fuera de rango.")
+        return
 
-    # Mostrar video capítulo con navegación (series)
-    elif data.startswith("cap_"):
-        _, serie_id, index = data.split("_")
-        index = int(index)
-        serie = series_data.get(serie_id)
-        
-        if not serie or "capitulos" not in serie:
-            await query.message.reply_text("❌ Serie o capítulos no disponibles.")
+    # APLICACIÓN DE LA SEGURIDAD PARA CAPÍTULOS DE SERIES AQUÍ
+    if await can_view_video(user_id): # Verifica si tiene vistas disponibles
+        video_id = await get_chapter_video(serie_id, index)
+        if video_id is None:
+            await query.message.reply_text("❌ Capítulo no disponible.")
             return
+        await register_view(user_id, f"serie_{serie_id}") # Registra la vista
 
-        capitulos = serie["capitulos"]
-        total = len(capitulos)
-        if index < 0 or index >= total:
-            await query.message.reply_text("❌ Capítulo fuera de rango.")
-            return
+        botones = []
+        if index > 0:
+            botones.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"cap_{serie_id}_{index - 1}"))
+        if index < total - 1:
+            botones.append(InlineKeyboardButton("➡️ Siguiente", callback_data=f"cap_{serie_id}_{index + 1}"))
 
-        # APLICACIÓN DE LA SEGURIDAD PARA CAPÍTULOS DE SERIES AQUÍ
-        if can_view_video(user_id): # Verifica si tiene vistas disponibles
-            await register_view(user_id) # Registra la vista
-            video_id = capitulos[index]
-
-            botones = []
-            if index > 0:
-                botones.append(InlineKeyboardButton("⬅️ Anterior", callback_data=f"cap_{serie_id}_{index - 1}"))
-            if index < total - 1:
-                botones.append(InlineKeyboardButton("➡️ Siguiente", callback_data=f"cap_{serie_id}_{index + 1}"))
-            
-            # Botón "Volver a la Serie" que regresará a la lista de capítulos
-            botones.append(InlineKeyboardButton("🔙 Volver a la Serie", callback_data=f"serie_list_{serie_id}")) # Nuevo callback para listar capítulos
-
-            markup = InlineKeyboardMarkup([botones])
-
-            await query.edit_message_media(
-                media=InputMediaVideo(
-                    media=video_id,
-                    caption=f"{serie['title']} - Capítulo {index+1}",
-                    parse_mode="Markdown"
-                ),
-                reply_markup=markup,
-            )
-        else:
-            await query.answer("🚫 Has alcanzado tu límite diario de videos. Compra un plan para más acceso.", show_alert=True)
-            await query.message.reply_text(
-                f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} videos.\n"
-                "💎 Por favor, considera comprar un plan para acceso ilimitado.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Comprar Planes", callback_data="planes")]]),
-            )
-    
-    # Nuevo callback para mostrar la lista de capítulos de una serie
-    elif data.startswith("serie_list_"):
-        serie_id = data.split("_")[2]
-        serie = series_data.get(serie_id)
-        if not serie:
-            await query.message.reply_text("❌ Serie no encontrada.")
-            return
-        
-        # APLICACIÓN DE LA SEGURIDAD PARA SERIES AQUÍ (al volver a la lista)
-        if not can_view_video(user_id): # Verifica si tiene vistas disponibles
-            await query.message.reply_text(
-                f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} vistas para series/videos.\n"
-                "💎 Por favor, considera comprar un plan para acceso ilimitado.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("💎 Comprar Planes", callback_data="planes")]]),
-            )
-            return
+        # Botón "Volver a la Serie": regresa a la página que contiene este capítulo
+        botones.append(InlineKeyboardButton("🔙 Volver a la Serie", callback_data=f"sp_{serie_id}_{chapter_page(index)}"))
 
-        capitulos = serie.get("capitulos", [])
-        if not capitulos:
-            await query.message.reply_text("❌ Esta serie no tiene capítulos disponibles aún.")
-            return
-        
-        # Reutilizar la función para generar los botones de los capítulos
-        markup = generate_chapter_buttons(serie_id, len(capitulos))
+        markup = InlineKeyboardMarkup([botones])
 
         await query.edit_message_media(
-            media=InputMediaPhoto(
-                media=serie["photo_id"],
-                caption=f"📺 *{serie['title']}*\n\n{serie['caption']}\n\nSelecciona un capítulo:",
+            media=InputMediaVideo(
+                media=video_id,
+                caption=f"{serie['title']} - Capítulo {index+1}",
                 parse_mode="Markdown"
             ),
             reply_markup=markup,
         )
+    else:
+        await query.answer("🚫 Has alcanzado tu límite diario de videos. Compra un plan para más acceso.", show_alert=True)
+        await query.message.reply_text(
+            f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} videos.\n"
+            "💎 Por favor, considera comprar un plan para acceso ilimitado.",
+            reply_markup=LIMIT_REACHED_MARKUP,
+        )
+
+@callback_router.exact("noop")
+async def cb_noop(query, context):
+    pass # Indicador de página: no hace nada
+
+# Mostrar la lista de capítulos de una serie (serie_list_ queda por mensajes antiguos)
+@callback_router.prefix("serie_list_", str)
+async def cb_serie_list(query, context, serie_id):
+    await cb_serie_page(query, context, serie_id, 0)
+
+@callback_router.prefix("sp_", str, int)
+async def cb_serie_page(query, context, serie_id, page):
+    user_id = query.from_user.id
+    serie = series_data.get(serie_id)
+    if not serie:
+        await query.message.reply_text("❌ Serie no encontrada.")
+        return
+
+    # APLICACIÓN DE LA SEGURIDAD PARA SERIES AQUÍ (al volver a la lista)
+    if not await can_view_video(user_id): # Verifica si tiene vistas disponibles
+        await query.message.reply_text(
+            f"🚫 Has alcanzado tu límite diario de {FREE_LIMIT_VIDEOS} vistas para series/videos.\n"
+            "💎 Por favor, considera comprar un plan para acceso ilimitado.",
+            reply_markup=LIMIT_REACHED_MARKUP,
+        )
+        return
+
+    num_capitulos = serie.get("num_capitulos", 0)
+    if not num_capitulos:
+        await query.message.reply_text("❌ Esta serie no tiene capítulos disponibles aún.")
+        return
+
+    # Reutilizar la función para generar los botones de los capítulos
+    markup = generate_chapter_buttons(serie_id, num_capitulos, page)
+
+    if query.message.photo:
+        # Cambio de página: la portada ya está, solo se cambia el teclado
+        await query.edit_message_reply_markup(reply_markup=markup)
+        return
+    await query.edit_message_media(
+        media=InputMediaPhoto(
+            media=serie["photo_id"],
+            caption=f"📺 *{serie['title']}*\n\n{serie['caption']}\n\nSelecciona un capítulo:",
+            parse_mode="Markdown"
+        ),
+        reply_markup=markup,
+    )
+
+@requires("catalog")
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    await callback_router.dispatch(query, context)
+
 
 
 # --- Pagos ---
 async def precheckout_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.pre_checkout_query.answer(ok=True)
 
+# Cada pago escribe solo el documento del usuario y su entrada en COLLECTION_PAYMENTS,
+# en una transacción. El id del cobro hace idempotente un update de pago reenviado, y
+# al usuario se le confirma solo cuando la escritura ya está en Firestore.
+PLAN_DAYS = 30
+PAID_PLANS = {
+    PLAN_PRO_ITEM["payload"]: "Plan Pro",
+    PLAN_ULTRA_ITEM["payload"]: "Plan Ultra",
+}
+PAYMENT_MAX_RETRIES = 3
+
 async def successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    payload = update.message.successful_payment.invoice_payload
-    # MODIFICADO: Guardar el tipo de plan junto con la fecha de expiración
-    if payload == PLAN_PRO_ITEM["payload"]:
-        expire_at = datetime.now(timezone.utc) + timedelta(days=30)
-        user_premium[user_id] = {"expire_at": expire_at, "plan_type": "plan_pro"}
-        await update.message.reply_text("🎉 ¡Gracias por tu compra! Tu *Plan Pro* se activó por 30 días.")
-    elif payload == PLAN_ULTRA_ITEM["payload"]:
-        expire_at = datetime.now(timezone.utc) + timedelta(days=30)
-        user_premium[user_id] = {"expire_at": expire_at, "plan_type": "plan_ultra"}
-        await update.message.reply_text("🎉 ¡Gracias por tu compra! Tu *Plan Ultra* se activó por 30 días.")
-    # Si tienes un 'PREMIUM_ITEM' original, asegúrate de manejarlo también.
-    # Ejemplo de manejo para el viejo "premium_plan" si aún lo usas:
-    # elif payload == PREMIUM_ITEM["payload"]:
-    #     expire_at = datetime.now(timezone.utc) + timedelta(days=30)
-    #     user_premium[user_id] = {"expire_at": expire_at, "plan_type": "premium_legacy"}
-    #     await update.message.reply_text("🎉 ¡Gracias por tu compra! Tu *Plan Premium* se activó por 30 días.")
-    
-    save_data()
+    payment = update.message.successful_payment
+    payload = payment.invoice_payload
+    plan_name = PAID_PLANS.get(payload)
+    if plan_name is None:
+        logger.error(f"Pago con payload desconocido {payload!r} de {user_id} (cobro {payment.telegram_payment_charge_id})")
+        await update.message.reply_text("⚠️ No reconocimos este pago. Escribe a soporte con este código: "
+                                        f"`{payment.telegram_payment_charge_id}`", parse_mode="Markdown")
+        return
+
+    # MODIFICADO: Guardar el tipo de plan (= payload) junto con la fecha de expiración
+    plan = {"expire_at": datetime.now(timezone.utc) + timedelta(days=PLAN_DAYS), "plan_type": payload}
+    record = {
+        "payload": payload,
+        "currency": payment.currency,
+        "total_amount": payment.total_amount,
+        "provider_payment_charge_id": payment.provider_payment_charge_id,
+    }
+    for attempt in range(1, PAYMENT_MAX_RETRIES + 1):
+        try:
+            applied, plan = await run_storage(record_payment_firestore, user_id, payment.telegram_payment_charge_id, plan, record)
+            break
+        except Exception as e:
+            logger.error(f"Error registrando el pago {payment.telegram_payment_charge_id} de {user_id} (intento {attempt}): {e}")
+            if attempt == PAYMENT_MAX_RETRIES:
+                await update.message.reply_text("⚠️ Recibimos tu pago pero no pudimos activar el plan. Escribe a soporte con este código: "
+                                                f"`{payment.telegram_payment_charge_id}`", parse_mode="Markdown")
+                return
+            await asyncio.sleep(attempt)
+
+    if not applied:
+        # Update reenviado, o un reintento de un commit que sí había llegado
+        logger.info(f"Pago {payment.telegram_payment_charge_id} de {user_id} ya registrado")
+    # La escritura ya está en Firestore: se actualiza la caché sin marcar nada pendiente,
+    # sin pisar un plan posterior al de este cobro
+    await ensure_user_loaded(user_id)
+    cached = user_premium.get(user_id)
+    if plan is not None and not (isinstance(cached, dict) and cached["expire_at"] >= plan["expire_at"]):
+        user_premium[user_id] = plan
+    exp_date = plan["expire_at"].strftime("%Y-%m-%d") if plan else "-"
+    await update.message.reply_text(f"🎉 ¡Gracias por tu compra! Tu *{plan_name}* está activo hasta {exp_date}.", parse_mode="Markdown")
+
+
+# --- Difusión a grupos ---
+# Los envíos a known_chats corren en segundo plano con concurrencia acotada,
+# un token bucket global y un intervalo mínimo por chat según los límites de Telegram
+# (~30 mensajes/s en total y ~20 mensajes/min por grupo).
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_GLOBAL_RATE = float(os.getenv("BROADCAST_GLOBAL_RATE", "25"))             # mensajes/segundo
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "3"))  # segundos entre envíos al mismo chat
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_PROGRESS_INTERVAL = 5  # segundos entre actualizaciones de progreso al admin
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+broadcast_bucket = TokenBucket(BROADCAST_GLOBAL_RATE)
+_chat_next_send = {}  # {chat_id: instante (monotonic) a partir del cual se puede volver a enviar}
+
+async def _wait_chat_slot(chat_id, delay=0):
+    now = time.monotonic()
+    slot = max(now + delay, _chat_next_send.get(chat_id, 0))
+    _chat_next_send[chat_id] = slot + BROADCAST_PER_CHAT_INTERVAL
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+# --- Limpieza de chats muertos ---
+# Los chats donde el bot fue expulsado o que ya no existen se quitan de known_chats;
+# los grupos migrados a supergrupo se reescriben con el nuevo id.
+def forget_chat(chat_id, reason):
+    if chat_id in known_chats:
+        known_chats.discard(chat_id)
+        mark_dirty(COLLECTION_CHATS, chat_id)
+        logger.info(f"Chat {chat_id} eliminado de known_chats: {reason}")
+
+def migrate_chat(old_chat_id, new_chat_id):
+    known_chats.discard(old_chat_id)
+    known_chats.add(new_chat_id)
+    mark_dirty(COLLECTION_CHATS, old_chat_id)
+    mark_dirty(COLLECTION_CHATS, new_chat_id)
+    logger.info(f"Chat {old_chat_id} migrado a {new_chat_id}")
+
+# Resultado de un envío: los chats con fallo permanente no se reintentan nunca; los
+# transitorios (timeouts, 5xx, flood control agotado) quedan pendientes en el trabajo.
+SEND_OK = "ok"
+SEND_PERMANENT = "permanent"
+SEND_TRANSIENT = "transient"
+
+async def send_broadcast_photo(bot, chat_id, photo_id, caption):
+    """Envía una foto a un chat respetando los límites; reintenta tras RetryAfter.
+    Quita de known_chats los chats inaccesibles y sigue las migraciones a supergrupo."""
+    delay = 0
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await _wait_chat_slot(chat_id, delay)
+        await broadcast_bucket.acquire()
+        delay = 0
+        try:
+            await bot.send_photo(
+                chat_id=chat_id,
+                photo=photo_id,
+                caption=caption,
+                parse_mode="Markdown",
+                protect_content=False,
+            )
+            return SEND_OK
+        except RetryAfter as e:
+            logger.warning(f"Flood control en {chat_id}, reintento en {e.retry_after}s")
+            delay = e.retry_after
+        except ChatMigrated as e:
+            migrate_chat(chat_id, e.new_chat_id)
+            chat_id = e.new_chat_id
+        except Forbidden as e:
+            forget_chat(chat_id, e.message)
+            return SEND_PERMANENT
+        except BadRequest as e:
+            if "chat not found" in e.message.lower():
+                forget_chat(chat_id, e.message)
+            else:
+                logger.warning(f"No se pudo enviar a {chat_id}: {e}")
+            return SEND_PERMANENT
+        except Exception as e:
+            logger.warning(f"No se pudo enviar a {chat_id}: {e}")
+            return SEND_TRANSIENT
+    return SEND_TRANSIENT
+
+# --- Trabajos de difusión reanudables ---
+# Cada difusión es una cabecera en broadcast_jobs con contadores, y la lista de chats
+# destino queda congelada en trozos de BROADCAST_CHUNK_SIZE en la subcolección "chunks"
+# ({"chat_ids", "done"}), así ningún documento se acerca al límite de 1 MiB. Los
+# checkpoints solo añaden los ids nuevos a "done" con ArrayUnion. Tras un reinicio se
+# reanuda con los chats que no están en "done": como mucho se repiten los envíos hechos
+# después del último checkpoint. Al terminar se borran los trozos y la cabecera caduca
+# por expire_at (política TTL de Firestore).
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "20"))        # chats procesados
+BROADCAST_CHECKPOINT_INTERVAL = int(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", "10"))  # segundos
+BROADCAST_CHUNK_SIZE = 2000
+BROADCAST_JOB_RETENTION_DAYS = int(os.getenv("BROADCAST_JOB_RETENTION_DAYS", "7"))
+SUBCOLLECTION_BROADCAST_CHUNKS = "chunks"
+
+def broadcast_job_ref(job_id):
+    return db.collection(COLLECTION_BROADCASTS).document(job_id)
+
+def broadcast_chunk_ref(job_id, chunk):
+    return broadcast_job_ref(job_id).collection(SUBCOLLECTION_BROADCAST_CHUNKS).document(f"{chunk:05d}")
+
+def split_broadcast_chunks(chat_ids):
+    return [chat_ids[i:i + BROADCAST_CHUNK_SIZE] for i in range(0, len(chat_ids), BROADCAST_CHUNK_SIZE)]
+
+def new_broadcast_job(header, chunks):
+    """Trabajo en memoria: la cabecera más {trozo: {"chat_ids", "done"}}."""
+    return dict(header, chunks={i: {"chat_ids": ids, "done": []} for i, ids in enumerate(chunks)})
+
+def save_broadcast_job_firestore(job_id, header, chunks):
+    # Primero los trozos y la cabecera al final: una cabecera "running" siempre tiene su lista
+    writes = [
+        (broadcast_chunk_ref(job_id, i), {"chat_ids": chat_ids, "done": [], "expire_at": header["expire_at"]})
+        for i, chat_ids in enumerate(chunks)
+    ]
+    writes.append((broadcast_job_ref(job_id), header))
+    commit_writes(writes)
+
+def checkpoint_broadcast_job_firestore(job_id, done_by_chunk, delivered, failed, status):
+    """Añade a cada trozo solo los chats procesados desde el último checkpoint."""
+    batch = db.batch()
+    for chunk, chat_ids in done_by_chunk.items():
+        batch.update(broadcast_chunk_ref(job_id, chunk), {"done": firestore.ArrayUnion(chat_ids)})
+    batch.update(broadcast_job_ref(job_id), {
+        "delivered": firestore.Increment(delivered),
+        "failed": firestore.Increment(failed),
+        "status": status,
+    })
+    batch.commit()
 
+def finish_broadcast_job_firestore(job_id, num_chunks):
+    commit_writes([(broadcast_chunk_ref(job_id, i), None) for i in range(num_chunks)])
+
+def migrate_legacy_broadcast_job_firestore(job_id, job):
+    """Formato anterior: un solo documento con chat_ids, delivered y failed completos."""
+    done = set(job.get("delivered", [])) | set(job.get("failed", []))
+    chunks = split_broadcast_chunks([chat_id for chat_id in job["chat_ids"] if chat_id not in done])
+    created_at = datetime.fromisoformat(job["created_at"])
+    header = {
+        "photo_id": job["photo_id"],
+        "caption": job["caption"],
+        "admin_chat_id": job["admin_chat_id"],
+        "label": job["label"],
+        "total": len(job["chat_ids"]),
+        "num_chunks": len(chunks),
+        "delivered": len(job.get("delivered", [])),
+        "failed": len(job.get("failed", [])),
+        "status": "running",
+        "created_at": job["created_at"],
+        "expire_at": created_at + timedelta(days=BROADCAST_JOB_RETENTION_DAYS),
+    }
+    # La cabecera reemplaza al documento antiguo (set sin merge) y descarta sus listas
+    save_broadcast_job_firestore(job_id, header, chunks)
+    return new_broadcast_job(header, chunks)
+
+def load_pending_broadcast_jobs_firestore():
+    jobs = {}
+    for doc in db.collection(COLLECTION_BROADCASTS).where("status", "==", "running").stream():
+        job = doc.to_dict()
+        if "chat_ids" in job:
+            jobs[doc.id] = migrate_legacy_broadcast_job_firestore(doc.id, job)
+            continue
+        chunks = doc.reference.collection(SUBCOLLECTION_BROADCAST_CHUNKS).stream()
+        job["chunks"] = {int(chunk.id): chunk.to_dict() for chunk in chunks}
+        jobs[doc.id] = job
+    return jobs
+
+async def start_broadcast(bot, photo_id, caption, admin_chat_id, label):
+    """Registra el trabajo de difusión y lo lanza en segundo plano."""
+    job_id = f"{int(datetime.utcnow().timestamp() * 1000)}_{admin_chat_id}"
+    chat_ids = list(known_chats)
+    chunks = split_broadcast_chunks(chat_ids)
+    now = datetime.now(timezone.utc)
+    header = {
+        "photo_id": photo_id,
+        "caption": caption,
+        "admin_chat_id": admin_chat_id,
+        "label": label,
+        "total": len(chat_ids),
+        "num_chunks": len(chunks),
+        "delivered": 0,
+        "failed": 0,
+        "status": "running",
+        "created_at": now.isoformat(),
+        "expire_at": now + timedelta(days=BROADCAST_JOB_RETENTION_DAYS),
+    }
+    await run_storage(save_broadcast_job_firestore, job_id, header, chunks)
+    job = new_broadcast_job(header, chunks)
+    app_telegram.create_task(broadcast_photo(bot, job_id, job))
+
+async def resume_broadcast_jobs(bot):
+    jobs = await run_storage(load_pending_broadcast_jobs_firestore)
+    for job_id, job in jobs.items():
+        logger.info(f"📤 Reanudando difusión {job_id}")
+        app_telegram.create_task(broadcast_photo(bot, job_id, job))
+
+async def broadcast_photo(bot, job_id, job):
+    """Envía la publicación a los chats pendientes del trabajo e informa el progreso al admin."""
+    photo_id = job["photo_id"]
+    caption = job["caption"]
+    label = job["label"]
+    total = job["total"]
+    pending = []  # (trozo, chat_id)
+    for chunk, data in sorted(job["chunks"].items()):
+        done = set(data.get("done", []))
+        pending.extend((chunk, chat_id) for chat_id in data["chat_ids"] if chat_id not in done)
+    sent = job.get("delivered", 0)
+    failed = job.get("failed", 0)
+    resumed = len(pending) < total
+    try:
+        status = await bot.send_message(
+            job["admin_chat_id"],
+            f"📤 Enviando {label} a {total} grupos..." if not resumed else f"📤 Reanudando envío de {label}: {total - len(pending)}/{total}...",
+        )
+    except Exception as e:
+        # La difusión no depende del mensaje de progreso (admin bloqueó el bot, flood, timeout)
+        logger.warning(f"No se pudo enviar el progreso de la difusión {job_id} al admin: {e}")
+        status = None
+    last_report = last_checkpoint = time.monotonic()
+    since_checkpoint = 0
+    checkpointing = False
+    unsaved = {}             # {trozo: [chat_id]} procesados desde el último checkpoint
+    unsaved_counts = [0, 0]  # [entregados, fallidos permanentes] desde el último checkpoint
+    transient = []           # (trozo, chat_id) con fallo transitorio en esta pasada
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+    async def checkpoint(state="running"):
+        nonlocal checkpointing, since_checkpoint, last_checkpoint, unsaved, unsaved_counts
+        checkpointing = True
+        since_checkpoint = 0
+        last_checkpoint = time.monotonic()
+        done_by_chunk, counts = unsaved, unsaved_counts
+        unsaved, unsaved_counts = {}, [0, 0]
+        try:
+            await run_storage(checkpoint_broadcast_job_firestore, job_id, done_by_chunk, counts[0], counts[1], state)
+        except Exception as e:
+            # Se devuelven para el próximo checkpoint
+            for chunk, chat_ids in done_by_chunk.items():
+                unsaved.setdefault(chunk, []).extend(chat_ids)
+            unsaved_counts[0] += counts[0]
+            unsaved_counts[1] += counts[1]
+            logger.error(f"Error guardando checkpoint de difusión {job_id}: {e}")
+            return False
+        finally:
+            checkpointing = False
+        return True
+
+    async def report(text):
+        if status is None:
+            return
+        try:
+            await status.edit_text(text)
+        except Exception as e:
+            logger.warning(f"No se pudo actualizar el progreso de la difusión: {e}")
+
+    async def deliver(chunk, chat_id):
+        nonlocal sent, failed, last_report, since_checkpoint
+        async with semaphore:
+            result = await send_broadcast_photo(bot, chat_id, photo_id, caption)
+        if result == SEND_TRANSIENT:
+            # No se marca como hecho: se reintenta al final o al reanudar el trabajo
+            transient.append((chunk, chat_id))
+            return
+        if result == SEND_OK:
+            sent += 1
+            unsaved_counts[0] += 1
+        else:
+            failed += 1
+            unsaved_counts[1] += 1
+        unsaved.setdefault(chunk, []).append(chat_id)
+        since_checkpoint += 1
+        if not checkpointing and (
+            since_checkpoint >= BROADCAST_CHECKPOINT_EVERY
+            or time.monotonic() - last_checkpoint >= BROADCAST_CHECKPOINT_INTERVAL
+        ):
+            await checkpoint()
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await report(f"📤 Enviando {label}: {sent + failed}/{total} ({failed} fallidos)...")
+
+    await asyncio.gather(*(deliver(chunk, chat_id) for chunk, chat_id in pending))
+    if transient:
+        # Una segunda pasada para los fallos transitorios; los que sigan fallando se dan por perdidos
+        retry, transient = transient, []
+        logger.info(f"Difusión {job_id}: reintentando {len(retry)} chats con fallo transitorio")
+        await asyncio.gather(*(deliver(chunk, chat_id) for chunk, chat_id in retry))
+    failed += len(transient)
+    unsaved_counts[1] += len(transient)
+    while checkpointing:
+        await asyncio.sleep(0.1)
+    if await checkpoint("done"):
+        try:
+            await run_storage(finish_broadcast_job_firestore, job_id, job["num_chunks"])
+        except Exception as e:
+            logger.error(f"Error borrando los trozos de la difusión {job_id}: {e}")
+    try:
+        # Persistir los chats eliminados o migrados durante la difusión
+        await save_data_async()
+    except Exception as e:
+        logger.error(f"Error guardando known_chats tras la difusión: {e}")
+    await report(f"✅ {label.capitalize()} enviado a {sent}/{total} grupos ({failed} fallidos).")
 
 # --- Recepción contenido (sinopsis + video) ---
 async def recibir_foto(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -699,10 +2215,10 @@ async def recibir_foto(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await msg.reply_text("❌ Envía una imagen con sinopsis.")
 
+@requires("catalog", "chats")
 async def recibir_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     user_id = msg.from_user.id
-    bot_username = (await context.bot.get_me()).username
 
     if user_id not in current_photo:
         await msg.reply_text("❌ Primero envía una sinopsis con imagen.")
@@ -720,9 +2236,12 @@ async def recibir_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     del current_photo[user_id]
 
-    save_data()
+    mark_dirty(COLLECTION_VIDEOS, pkg_id)
+    catalog_changed()
+    index_video(pkg_id)
+    await save_data_async()
 
-    direct_url = f"https://t.me/{bot_username}?start=video_{pkg_id}"
+    direct_url = build_deep_link(f"video_{pkg_id}")
     
     # Formato mejorado para clicable
     full_caption = (
@@ -731,19 +2250,9 @@ async def recibir_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"➡️ [ver contenido ]({direct_url})\n" # Enlace clicable
     )
 
-    for chat_id in known_chats:
-        try:
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=photo_id,
-                caption=full_caption,
-                parse_mode="Markdown",
-                protect_content=False,
-            )
-        except Exception as e:
-            logger.warning(f"No se pudo enviar a {chat_id}: {e}")
-
-    await msg.reply_text("✅ Contenido enviado a los grupos.")
+    # La difusión corre en segundo plano; el progreso se informa en un mensaje aparte
+    await start_broadcast(context.bot, photo_id, full_caption, msg.chat_id, "contenido")
+    await msg.reply_text("✅ Contenido guardado. Enviando a los grupos...")
 
 # --- Comandos para series (simplificado) ---
 async def crear_serie(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -793,10 +2302,13 @@ async def recibir_video_serie(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     serie = current_series[user_id]
     video_id = msg.video.file_id
+    # Los capítulos quedan en memoria hasta /finalizar_serie: una serie abandonada no
+    # deja documentos huérfanos en Firestore
     serie["capitulos"].append(video_id)
 
     await msg.reply_text(f"✅ Capítulo {len(serie['capitulos'])} agregado a la serie. Usa /finalizar_serie para guardar la serie o envía otro video para añadir el siguiente capítulo.")
 
+@requires("catalog", "chats")
 async def finalizar_serie(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Finaliza y guarda la serie creada en Firestore y memoria."""
     user_id = update.message.from_user.id
@@ -810,13 +2322,20 @@ async def finalizar_serie(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "title": serie["title"],
         "photo_id": serie["photo_id"],
         "caption": serie["caption"],
-        "capitulos": serie["capitulos"],
+        "num_capitulos": len(serie["capitulos"]),
     }
-    save_data()
+    # Un documento pequeño por capítulo; _dirty los escribe antes que la cabecera
+    for index, video_id in enumerate(serie["capitulos"]):
+        cache_chapter(serie_id, index, video_id)
+        mark_dirty(SUBCOLLECTION_CHAPTERS, (serie_id, index))
+    mark_dirty(COLLECTION_SERIES, serie_id)
+    catalog_changed()
+    invalidate_chapter_grids(serie_id)
+    index_serie(serie_id)
+    await save_data_async()
     del current_series[user_id]
 
-    bot_username = (await context.bot.get_me()).username
-    direct_url = f"https://t.me/{bot_username}?start=serie_{serie_id}"
+    direct_url = build_deep_link(f"serie_{serie_id}")
     
     # Formato mejorado para clicable
     full_caption = (
@@ -825,28 +2344,19 @@ async def finalizar_serie(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"➡️ [ver contenido ]({direct_url})\n" # Enlace clicable
     )
 
-    for chat_id in known_chats:
-        try:
-            await context.bot.send_photo(
-                chat_id=chat_id,
-                photo=serie["photo_id"],
-                caption=full_caption,
-                parse_mode="Markdown",
-                protect_content=False,
-            )
-        except Exception as e:
-            logger.warning(f"No se pudo enviar serie a {chat_id}: {e}")
-
-    await update.message.reply_text("✅ Serie guardada y enviada a los grupos.")
+    await start_broadcast(context.bot, serie["photo_id"], full_caption, update.message.chat_id, "serie")
+    await update.message.reply_text("✅ Serie guardada. Enviando a los grupos...")
 
 # MODIFICADO: Función para detectar grupos y canales
+@requires("chats")
 async def detectar_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = update.effective_chat
     # Check for group/supergroup messages
     if chat.type in ["group", "supergroup"]:
         if chat.id not in known_chats:
             known_chats.add(chat.id)
-            save_data()
+            mark_dirty(COLLECTION_CHATS, chat.id)
+            await save_data_async()
             logger.info(f"Grupo registrado: {chat.id}")
             await update.message.reply_text(f"✅ ¡Este grupo ha sido registrado para envíos! ID: `{chat.id}`", parse_mode="Markdown")
     # Check for forwarded channel posts or bot added to channel
@@ -854,7 +2364,8 @@ async def detectar_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = update.channel_post.chat.id
         if channel_id not in known_chats:
             known_chats.add(channel_id)
-            save_data()
+            mark_dirty(COLLECTION_CHATS, channel_id)
+            await save_data_async()
             logger.info(f"Canal registrado: {channel_id}")
             await context.bot.send_message(
                 chat_id=channel_id,
@@ -866,7 +2377,8 @@ async def detectar_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = update.message.forward_from_chat.id
         if channel_id not in known_chats:
             known_chats.add(channel_id)
-            save_data()
+            mark_dirty(COLLECTION_CHATS, channel_id)
+            await save_data_async()
             logger.info(f"Canal registrado via forward: {channel_id}")
             await update.message.reply_text(f"✅ ¡Canal registrado exitosamente! ID: `{channel_id}`\n\n"
                                              "Asegúrate de que el bot sea administrador con permisos de 'Publicar mensajes' y 'Editar mensajes' en tu canal para que pueda enviar contenido automáticamente.",
@@ -877,30 +2389,311 @@ async def detectar_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # --- WEBHOOK aiohttp ---
+# Los updates entran en una cola acotada y se responde 200 enseguida. Si la cola está
+# llena se devuelve 503 con Retry-After y Telegram reintenta más tarde.
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "1000"))
+INGEST_RETRY_AFTER = int(os.getenv("INGEST_RETRY_AFTER", "5"))  # segundos
+ingest_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+ingest_metrics = {
+    "accepted": 0,
+    "rejected": 0,
+    "duplicates": 0,
+    "filtered": 0,     # tipos de update sin handler
+    "wait_last": 0.0,  # segundos en cola del último update procesado
+    "wait_avg": 0.0,   # media móvil exponencial
+    "wait_max": 0.0,
+}
+
+def record_ingest_wait(enqueued_at):
+    wait = time.monotonic() - enqueued_at
+    ingest_metrics["wait_last"] = wait
+    ingest_metrics["wait_avg"] = 0.9 * ingest_metrics["wait_avg"] + 0.1 * wait
+    ingest_metrics["wait_max"] = max(ingest_metrics["wait_max"], wait)
+
+# --- Deduplicación de updates ---
+# Telegram reenvía un update si el webhook tarda en responder. Se recuerdan los últimos
+# UPDATE_DEDUP_SIZE update_id aceptados y las repeticiones se descartan antes de construir el Update.
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+_seen_update_ids = set()
+_seen_update_order = deque()
+
+def remember_update(update_id):
+    _seen_update_ids.add(update_id)
+    _seen_update_order.append(update_id)
+    if len(_seen_update_order) > UPDATE_DEDUP_SIZE:
+        _seen_update_ids.discard(_seen_update_order.popleft())
+
+# --- Grabación de payloads para bench_webhook.py ---
+# Con WEBHOOK_RECORD_PATH el handler solo encola el payload; un task lo escribe en un
+# hilo aparte, anonimizado (nombres, textos, pagos) salvo WEBHOOK_RECORD_RAW=1 (solo
+# desarrollo), y al pasar de WEBHOOK_RECORD_MAX_BYTES rota el archivo a ".1".
+WEBHOOK_RECORD_PATH = os.getenv("WEBHOOK_RECORD_PATH")
+WEBHOOK_RECORD_RAW = os.getenv("WEBHOOK_RECORD_RAW", "0") == "1"
+WEBHOOK_RECORD_MAX_BYTES = int(os.getenv("WEBHOOK_RECORD_MAX_BYTES", str(50 * 1024 * 1024)))
+WEBHOOK_RECORD_BATCH = 100
+record_queue = asyncio.Queue(maxsize=1000)
+
+def write_recorded_payloads(payloads):
+    lines = []
+    for raw in payloads:
+        if not WEBHOOK_RECORD_RAW:
+            raw = json.dumps(webhook_codec.redact(json.loads(raw)), ensure_ascii=False).encode("utf-8")
+        lines.append(raw.replace(b"\n", b"") + b"\n")
+    if os.path.exists(WEBHOOK_RECORD_PATH) and os.path.getsize(WEBHOOK_RECORD_PATH) >= WEBHOOK_RECORD_MAX_BYTES:
+        os.replace(WEBHOOK_RECORD_PATH, WEBHOOK_RECORD_PATH + ".1")
+    with open(WEBHOOK_RECORD_PATH, "ab") as f:
+        f.writelines(lines)
+
+async def payload_recorder():
+    if not WEBHOOK_RECORD_PATH:
+        return
+    loop = asyncio.get_running_loop()
+    while True:
+        payloads = [await record_queue.get()]
+        while not record_queue.empty() and len(payloads) < WEBHOOK_RECORD_BATCH:
+            payloads.append(record_queue.get_nowait())
+        try:
+            await loop.run_in_executor(None, write_recorded_payloads, payloads)
+        except Exception as e:
+            logger.warning(f"No se pudieron grabar {len(payloads)} payloads: {e}")
+
 async def webhook_handler(request):
-    data = await request.json()
+    raw = await request.read()
+    if WEBHOOK_RECORD_PATH and not record_queue.full():
+        record_queue.put_nowait(raw) # Con la cola llena se pierde la muestra, no el update
+    data = webhook_codec.loads(raw)
+    update_id = data.get("update_id")
+    if update_id in _seen_update_ids:
+        ingest_metrics["duplicates"] += 1
+        return web.Response(text="OK")
+    if not webhook_codec.is_handled(data, HANDLED_UPDATE_TYPES):
+        # Ningún handler lo usa: no vale la pena construir el Update
+        ingest_metrics["filtered"] += 1
+        return web.Response(text="OK")
     update = Update.de_json(data, app_telegram.bot)
-    await app_telegram.update_queue.put(update)
+    try:
+        ingest_queue.put_nowait((time.monotonic(), update))
+    except asyncio.QueueFull:
+        # No se recuerda: el reintento de Telegram debe poder entrar
+        ingest_metrics["rejected"] += 1
+        logger.warning(f"Cola de updates llena ({INGEST_QUEUE_SIZE}), rechazando update {update_id}")
+        return web.Response(status=503, text="Busy", headers={"Retry-After": str(INGEST_RETRY_AFTER)})
+    remember_update(update_id)
+    ingest_metrics["accepted"] += 1
     return web.Response(text="OK")
 
-async def on_startup(app):
+# --- Procesamiento concurrente con orden por usuario ---
+# Cada usuario (o chat) con updates pendientes tiene su propia cola y un task que la
+# vacía en orden, así register_view y los límites de plan se evalúan en orden para ese
+# usuario. Un update lento solo retrasa los siguientes del mismo usuario, no a otros.
+# UPDATE_CONCURRENCY acota los handlers en paralelo y UPDATE_PENDING_MAX los updates
+# repartidos sin terminar: al llegar a ese tope se deja de vaciar ingest_queue (→ 503).
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+UPDATE_PENDING_MAX = int(os.getenv("UPDATE_PENDING_MAX", "800"))
+_update_slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+_pending_slots = asyncio.Semaphore(UPDATE_PENDING_MAX)
+_user_queues = {}  # {clave: deque((encolado_en, update))} solo de usuarios con updates pendientes
+_user_workers = set()
+UPDATE_DRAIN_TIMEOUT = 20  # segundos para terminar los updates pendientes al detenerse (Render espera 30 tras SIGTERM)
+
+def update_key(update):
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return update.update_id
+
+async def dispatch_updates():
+    while True:
+        await _pending_slots.acquire()
+        item = await ingest_queue.get()
+        key = update_key(item[1])
+        queue = _user_queues.get(key)
+        if queue is None:
+            queue = _user_queues[key] = deque()
+            worker = asyncio.create_task(user_worker(key, queue))
+            _user_workers.add(worker)
+            worker.add_done_callback(_user_workers.discard)
+        queue.append(item)
+        ingest_queue.task_done()
+
+async def user_worker(key, queue):
+    # Termina en cuanto su cola queda vacía; el próximo update del usuario crea otro
+    try:
+        while queue:
+            enqueued_at, update = queue.popleft()
+            try:
+                async with _update_slots:
+                    record_ingest_wait(enqueued_at)
+                    await app_telegram.process_update(update)
+            except Exception as e:
+                logger.error(f"Error procesando update {update.update_id}: {e}")
+            finally:
+                _pending_slots.release()
+    finally:
+        del _user_queues[key]
+
+async def drain_updates(timeout):
+    deadline = time.monotonic() + timeout
+    while (not ingest_queue.empty() or _user_workers) and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    if not ingest_queue.empty() or _user_workers:
+        logger.warning(f"Se detiene con {ingest_queue.qsize()} updates en cola y {len(_user_workers)} usuarios en curso")
+
+def start_update_processing():
+    return [asyncio.create_task(dispatch_updates())]
+
+async def metrics_handler(request):
+    return web.json_response({
+        "ingest": dict(
+            ingest_metrics,
+            depth=ingest_queue.qsize(),
+            capacity=INGEST_QUEUE_SIZE,
+            active_users=len(_user_queues),
+            pending=sum(len(queue) for queue in _user_queues.values()),
+        ),
+        "bot_api": {"send": send_request.metrics, "get_updates": get_updates_request.metrics},
+        "callbacks": callback_router.metrics,
+    })
+
+async def ping_handler(request):
+    # Vivo desde que se abre el puerto; "ready" indica qué estados ya se cargaron
+    states = {name: event.is_set() for name, event in _ready.items()}
+    return web.json_response({
+        "status": "✅ Bot activo.",
+        "alive": True,
+        "ready": all(states.values()),
+        "states": states,
+    })
+
+async def register_webhook():
     webhook_url = f"{APP_URL}/webhook"
-    await app_telegram.bot.set_webhook(webhook_url)
-    logger.info(f"Webhook configurado en {webhook_url}")
+    await app_telegram.bot.set_webhook(webhook_url, allowed_updates=list(HANDLED_UPDATE_TYPES))
+    logger.info(f"Webhook configurado en {webhook_url} (JSON: {webhook_codec.JSON_BACKEND})")
 
 async def on_shutdown(app):
     await app_telegram.bot.delete_webhook()
     logger.info("Webhook eliminado")
 
+# --- Cliente HTTP para la Bot API ---
+# Pool de conexiones, keep-alive, HTTP/2 y timeouts configurables. Las llamadas de envío
+# (reply_video, send_photo, get_chat_member, ...) y get_updates usan pools separados.
+BOT_API_POOL_SIZE = int(os.getenv("BOT_API_POOL_SIZE", "32"))
+BOT_API_KEEPALIVE = float(os.getenv("BOT_API_KEEPALIVE", "30"))          # segundos
+BOT_API_HTTP2 = os.getenv("BOT_API_HTTP2", "0") == "1"                   # requiere httpx[http2] (h2)
+BOT_API_CONNECT_TIMEOUT = float(os.getenv("BOT_API_CONNECT_TIMEOUT", "5"))
+BOT_API_READ_TIMEOUT = float(os.getenv("BOT_API_READ_TIMEOUT", "10"))
+BOT_API_WRITE_TIMEOUT = float(os.getenv("BOT_API_WRITE_TIMEOUT", "10"))
+BOT_API_POOL_TIMEOUT = float(os.getenv("BOT_API_POOL_TIMEOUT", "5"))
+# Timeouts de lectura por método, p. ej. "sendVideo=30,getChatMember=3"
+BOT_API_METHOD_TIMEOUTS = {
+    method.strip(): float(timeout)
+    for method, timeout in (
+        item.split("=", 1) for item in os.getenv("BOT_API_METHOD_TIMEOUTS", "").split(",") if "=" in item
+    )
+}
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest que mide la espera por una conexión libre y aplica timeouts por método."""
+
+    def __init__(self, pool_size, keepalive_expiry, method_timeouts=None, **kwargs):
+        # _build_client() se llama dentro de super().__init__(): los límites van antes
+        self._limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry,
+        )
+        super().__init__(connection_pool_size=pool_size, **kwargs)
+        # Un slot por conexión del pool: el tiempo esperando un slot es la espera de pool,
+        # y pool_timeout se aplica a esa espera (con los slots httpx nunca llega a esperar)
+        self._slots = asyncio.Semaphore(pool_size)
+        self._pool_timeout = kwargs.get("pool_timeout")
+        self._method_timeouts = method_timeouts or {}
+        self.metrics = {"requests": 0, "pool_wait_avg": 0.0, "pool_wait_max": 0.0, "pool_timeouts": 0}
+
+    def _build_client(self):
+        # PTB no expone keepalive_expiry; _build_client() es donde PTB crea (y tras
+        # shutdown() recrea) el cliente, así que aquí se sustituyen solo los límites
+        return httpx.AsyncClient(**{**self._client_kwargs, "limits": self._limits})
+
+    async def do_request(
+        self,
+        url,
+        method,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        method_timeout = self._method_timeouts.get(url.rsplit("/", 1)[-1])
+        if method_timeout is not None and read_timeout is BaseRequest.DEFAULT_NONE:
+            read_timeout = method_timeout
+        if pool_timeout is BaseRequest.DEFAULT_NONE:
+            pool_timeout = self._pool_timeout
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=pool_timeout)
+        except asyncio.TimeoutError as exc:
+            self.metrics["pool_timeouts"] += 1
+            raise TimedOut("Pool timeout: todas las conexiones están ocupadas") from exc
+        try:
+            wait = time.monotonic() - started
+            self.metrics["requests"] += 1
+            self.metrics["pool_wait_avg"] = 0.9 * self.metrics["pool_wait_avg"] + 0.1 * wait
+            self.metrics["pool_wait_max"] = max(self.metrics["pool_wait_max"], wait)
+            return await super().do_request(
+                url,
+                method,
+                request_data=request_data,
+                read_timeout=read_timeout,
+                write_timeout=write_timeout,
+                connect_timeout=connect_timeout,
+                pool_timeout=pool_timeout,
+            )
+        finally:
+            self._slots.release()
+
+def http2_available():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logger.warning("BOT_API_HTTP2=1 pero falta httpx[http2] (paquete h2): se usa HTTP/1.1")
+        return False
+    return True
+
+BOT_API_HTTP_VERSION = "2" if BOT_API_HTTP2 and http2_available() else "1.1"
+
+def build_bot_request(pool_size, method_timeouts=None):
+    return MeteredRequest(
+        pool_size=pool_size,
+        keepalive_expiry=BOT_API_KEEPALIVE,
+        method_timeouts=method_timeouts,
+        connect_timeout=BOT_API_CONNECT_TIMEOUT,
+        read_timeout=BOT_API_READ_TIMEOUT,
+        write_timeout=BOT_API_WRITE_TIMEOUT,
+        pool_timeout=BOT_API_POOL_TIMEOUT,
+        http_version=BOT_API_HTTP_VERSION,
+    )
+
+send_request = build_bot_request(BOT_API_POOL_SIZE, BOT_API_METHOD_TIMEOUTS)
+get_updates_request = build_bot_request(1)
+
 # --- App Telegram ---
-app_telegram = Application.builder().token(TOKEN).build()
+app_telegram = (
+    Application.builder()
+    .token(TOKEN)
+    .request(send_request)
+    .get_updates_request(get_updates_request)
+    .build()
+)
 
 # Agregar handlers
 app_telegram.add_handler(CommandHandler("start", start))
 app_telegram.add_handler(CallbackQueryHandler(verify, pattern="^verify$"))
-app_telegram.add_handler(CallbackQueryHandler(handle_callback, pattern="^play_video_.*$"))
 app_telegram.add_handler(CallbackQueryHandler(handle_callback))
 app_telegram.add_handler(PreCheckoutQueryHandler(precheckout_handler))
+app_telegram.add_handler(InlineQueryHandler(inline_search))
 app_telegram.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment))
 app_telegram.add_handler(MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, recibir_foto))
 app_telegram.add_handler(MessageHandler(filters.VIDEO & filters.ChatType.PRIVATE, recibir_video_serie))
@@ -913,35 +2706,98 @@ app_telegram.add_handler(CommandHandler("crear_serie", crear_serie))
 app_telegram.add_handler(CommandHandler("agregar_capitulo", agregar_capitulo))
 app_telegram.add_handler(CommandHandler("finalizar_serie", finalizar_serie))
 
+# Tipos de update que consume cada clase de handler. La lista que se filtra en el webhook
+# y se envía como allowed_updates se calcula de los handlers registrados, así un handler
+# nuevo no se queda sin updates en silencio.
+MESSAGE_UPDATE_TYPES = ("message", "edited_message", "channel_post", "edited_channel_post")
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: ("message", "edited_message"),
+    MessageHandler: MESSAGE_UPDATE_TYPES,
+    CallbackQueryHandler: ("callback_query",),
+    PreCheckoutQueryHandler: ("pre_checkout_query",),
+    InlineQueryHandler: ("inline_query",),
+}
+
+def handled_update_types():
+    types = set()
+    for handlers in app_telegram.handlers.values():
+        for handler in handlers:
+            handler_types = HANDLER_UPDATE_TYPES.get(type(handler))
+            if handler_types is None:
+                # Handler sin mapeo: mejor recibir de más que perder sus updates
+                logger.error(f"{type(handler).__name__} no está en HANDLER_UPDATE_TYPES: se aceptan todos los tipos de update")
+                return tuple(Update.ALL_TYPES)
+            types.update(handler_types)
+    missing = types - set(webhook_codec.HANDLED_UPDATE_TYPES)
+    if missing:
+        logger.warning(f"webhook_codec.HANDLED_UPDATE_TYPES no incluye {sorted(missing)} (solo afecta a bench_webhook.py)")
+    return tuple(sorted(types))
+
+HANDLED_UPDATE_TYPES = handled_update_types()
+
 # --- Servidor aiohttp ---
 web_app = web.Application()
 web_app.router.add_post("/webhook", webhook_handler)
-web_app.router.add_get("/ping", lambda request: web.Response(text="✅ Bot activo."))
-web_app.on_startup.append(on_startup)
+web_app.router.add_get("/ping", ping_handler)
+web_app.router.add_get("/metrics", metrics_handler)
 web_app.on_shutdown.append(on_shutdown)
 
 async def main():
-    load_data()
-    logger.info("🤖 Bot iniciado con webhook")
-
-    await app_telegram.initialize()
-    await app_telegram.start()
-
+    # 1) Abrir el puerto de inmediato: /ping responde y los updates se encolan
     runner = web.AppRunner(web_app)
     await runner.setup()
     site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
     logger.info(f"🌐 Webhook corriendo en puerto {PORT}")
 
+    # 2) Estado local (sin red): diario de vistas e instantánea del catálogo
+    replay_views_journal()
+    from_snapshot = load_catalog_snapshot()
+    if from_snapshot:
+        _ready["catalog"].set()
+
+    await app_telegram.initialize()
+    await app_telegram.start()
+    await register_webhook()
+    logger.info("🤖 Bot iniciado con webhook")
+
+    # 3) Firestore en segundo plano
+    load_task = asyncio.create_task(load_state(from_snapshot))
+    snapshot_task = asyncio.create_task(catalog_snapshotter(catalog_version if from_snapshot else None))
+    views_flusher_task = asyncio.create_task(views_flusher())
+    journal_syncer_task = asyncio.create_task(views_journal_syncer())
+    update_tasks = start_update_processing()
+    recorder_task = asyncio.create_task(payload_recorder())
+
+    # Render detiene el servicio con SIGTERM: sin handler el proceso muere sin pasar por finally
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
     try:
-        while True:
-            await asyncio.sleep(3600)
-    except (KeyboardInterrupt, SystemExit):
+        await stop_event.wait()
         logger.info("🛑 Deteniendo bot...")
     finally:
+        load_task.cancel()
+        views_flusher_task.cancel()
+        journal_syncer_task.cancel()
+        snapshot_task.cancel()
+        recorder_task.cancel()
+        await runner.cleanup() # Deja de aceptar updates y elimina el webhook
+        # Los updates ya respondidos con 200 (en ingest_queue o en la cola de un usuario) se terminan de procesar
+        await drain_updates(UPDATE_DRAIN_TIMEOUT)
+        for task in update_tasks:
+            task.cancel()
+        await flush_views()
+        await sync_views_journal() # Lo que no llegó a Firestore queda en disco para replay
+        await flush_content_views()
+        await save_data_async()
+        if _ready["catalog"].is_set():
+            await save_catalog_snapshot()
         await app_telegram.stop()
         await app_telegram.shutdown()
-        await runner.cleanup()
+        storage_executor.shutdown(wait=True)
 
 if __name__ == "__main__":
     asyncio.run(main())
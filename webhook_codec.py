@@ -0,0 +1,75 @@
+"""Decodificación de los updates que llegan al webhook.
+
+Módulo sin dependencias de Firestore ni de variables de entorno del bot, para que
+bench_webhook.py pueda medirlo por separado.
+"""
+import os
+import json
+
+# Tipos de update por defecto para bench_webhook.py. bot8.py calcula los suyos a partir
+# de app_telegram.handlers (handled_update_types) y avisa si esta lista se queda corta.
+HANDLED_UPDATE_TYPES = (
+    "message",
+    "edited_message",
+    "channel_post",
+    "edited_channel_post",
+    "callback_query",
+    "pre_checkout_query",
+    "inline_query",
+)
+
+
+def _stdlib_loads(raw):
+    return json.loads(raw)
+
+
+def _load_backend(name):
+    if name == "orjson":
+        import orjson
+        return orjson.loads
+    if name == "ujson":
+        import ujson
+        return ujson.loads
+    if name == "json":
+        return _stdlib_loads
+    raise ValueError(f"Decodificador JSON desconocido: {name}")
+
+
+def select_json_backend(preferred=None):
+    """Devuelve (nombre, loads). Sin preferencia prueba orjson, ujson y por último json."""
+    candidates = [preferred] if preferred else ["orjson", "ujson", "json"]
+    for name in candidates:
+        try:
+            return name, _load_backend(name)
+        except ImportError:
+            continue
+    return "json", _stdlib_loads
+
+
+# Campos con datos personales que se anonimizan al grabar payloads: el valor se
+# sustituye por "x" de la misma longitud, así el tamaño y la estructura se conservan.
+REDACTED_FIELDS = frozenset({
+    "first_name", "last_name", "username", "title", "text", "caption", "query",
+    "phone_number", "email", "bio", "description", "address", "shipping_address",
+    "invoice_payload", "telegram_payment_charge_id", "provider_payment_charge_id", "order_info",
+})
+
+
+# WEBHOOK_JSON_BACKEND fuerza un decodificador (orjson, ujson o json)
+JSON_BACKEND, loads = select_json_backend(os.getenv("WEBHOOK_JSON_BACKEND"))
+
+
+def is_handled(data, handled_types=HANDLED_UPDATE_TYPES):
+    """Filtro previo: True si el update trae algún tipo que tenga handler."""
+    return any(key in data for key in handled_types)
+
+
+def redact(value, key=None):
+    """Copia de un update decodificado sin los campos de REDACTED_FIELDS."""
+    if key in REDACTED_FIELDS:
+        return "x" * len(value) if isinstance(value, str) else None
+    if isinstance(value, dict):
+        return {k: redact(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact(v, key) for v in value]
+    return value